@@ -0,0 +1,273 @@
+#!/usr/bin/python
+
+# Falcon-BCC
+# Copyright 2021-2024 Dino Duratović
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Benchmarks for Falcon-BCC. Runs on any platform: the shared memory is replaced
+# by file-backed mappings and keys go to a recording input backend.
+
+import argparse
+import ctypes
+import importlib.util
+import json
+import os
+import platform
+import random
+import statistics
+import struct
+import sys
+import tempfile
+import time
+
+def load_falcon_bcc():
+    """Import falcon-bcc.py, which can't be imported by name."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "falcon-bcc.py")
+    spec = importlib.util.spec_from_file_location("falcon_bcc", path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["falcon_bcc"] = module
+    spec.loader.exec_module(module)
+    return module
+
+bcc = load_falcon_bcc()
+
+def generate_keyfile(lines, seed=0, required_share=0.5):
+    """Generate a keyfile with the given number of lines
+
+    Mixes comments, empty lines, DirectX bindings, keyboard bindings of made up
+    callbacks and lines for a share of the required callbacks (some of them
+    unassigned). Only so many keys are used that the required callbacks can
+    still be assigned; the remaining lines are unassigned, like most lines of a
+    real keyfile. Returns the keyfile as bytes."""
+    rng = random.Random(seed)
+    modifiers = ["0", "1", "2", "3", "4", "6", "7"]
+    free_keys = [(key, modifier) for key in bcc.KEYBOARD_SCANCODES for modifier in modifiers]
+    rng.shuffle(free_keys)
+    reserved = 2 * len(bcc.REQUIRED_CALLBACKS)
+    required = rng.sample(bcc.REQUIRED_CALLBACKS, int(len(bcc.REQUIRED_CALLBACKS) * required_share))
+    output = ["# generated by the Falcon-BCC benchmark\n"]
+    for number in range(lines):
+        roll = rng.random()
+        if required and roll < 0.02:
+            callback = required.pop()
+            key, modifier = free_keys.pop() if rng.random() < 0.7 else ("0xFFFFFFFF", "0")
+            output.append('{} -1 0 {} {} 0 0 1 "{}"\n'.format(callback, key, modifier, callback))
+        elif roll < 0.1:
+            output.append("# comment {}\n".format(number))
+        elif roll < 0.15:
+            output.append("\n")
+        elif roll < 0.35:
+            output.append("SimDX{} {} -1 -2 0 0x0 0\n".format(number, rng.randrange(32)))
+        else:
+            key, modifier = free_keys.pop() if len(free_keys) > reserved else ("0xFFFFFFFF", "0")
+            output.append('SimBench{} -1 0 {} {} 0 0 1 "Benchmark callback {}"\n'.format(
+                number, key, modifier, number))
+    return "".join(output).encode("latin-1")
+
+def write_string_area(directory, values):
+    """Write a string area with the given {id: value} strings."""
+    data = b""
+    for index, id in enumerate(bcc.Strings.id):
+        value = values.get(id, "").encode("utf-8")
+        data += struct.pack("2I", index, len(value)) + value + b"\x00"
+    with open(os.path.join(directory, bcc.Strings.name), "wb") as area:
+        area.write(struct.pack("3I", 1, len(bcc.Strings.id), len(data)) + data)
+
+def write_shared_memory(directory, keyfile_path):
+    """Fill file-backed shared memory areas with packed structures."""
+    flightdata = bcc.FlightData()
+    flightdata.MainPower = 0
+    flightdata.lightBits2 = 0x10000
+    flightdata2 = bcc.FlightData2()
+    flightdata2.cmdsMode = 1
+    flightdata2.StringAreaTime = 1
+    intellivibedata = bcc.IntellivibeData()
+    intellivibedata.In3D = True
+    intellivibedata.IsOnGround = True
+    for structure in (flightdata, flightdata2, intellivibedata):
+        with open(os.path.join(directory, structure.name), "wb") as area:
+            area.write(bytes(structure))
+    write_string_area(directory, {"KeyFile": keyfile_path, "AcName": "F-16C-50"})
+
+def measure(function, min_time=0.2, max_runs=1000):
+    """Call a function repeatedly and return its timings in seconds."""
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < max_runs and (time.perf_counter() - started < min_time or len(timings) < 3):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return {"median": statistics.median(timings), "min": min(timings), "runs": len(timings)}
+
+def bench_keyfiles(workdir, sizes):
+    results = {}
+    for size in sizes:
+        path = os.path.join(workdir, "bench-{}.key".format(size))
+        with open(path, "wb") as keyfile:
+            keyfile.write(generate_keyfile(size, seed=size))
+
+        def parse():
+            keyfile = bcc.get_keyfile_content(path)
+            bcc.get_filtered_keyfile(keyfile)
+        results["keyfile_parse_{}".format(size)] = measure(parse)
+
+        keyfile = bcc.get_keyfile_content(path)
+        assigned = bcc.get_assigned_callbacks(keyfile)
+        unassigned = bcc.get_unassigned_callbacks(assigned)
+
+        def allocate():
+            unused_keys = bcc.get_unused_keys(bcc.get_used_keys(keyfile))
+            bcc.assign_unused_callbacks(unassigned, unused_keys)
+        results["unused_keys_{}".format(size)] = measure(allocate)
+    return results
+
+def bench_shared_memory(directory):
+    shared_memory = bcc.SharedMemory(directory)
+    results = {}
+    for name, projection in (
+            ("FlightData", bcc.FLIGHTDATA_READER),
+            ("FlightData2", bcc.FLIGHTDATA2_READER),
+            ("IntellivibeData", bcc.INTELLIVIBE_READER)):
+        results["shm_read_{}".format(name)] = measure(lambda: shared_memory.read(projection), max_runs=100000)
+    results["shm_strings_steady"] = measure(lambda: shared_memory.strings().KeyFile, max_runs=100000)
+
+    def changed():
+        shared_memory.strings_stamp = None
+        return shared_memory.strings().KeyFile
+    results["shm_strings_changed"] = measure(changed, max_runs=100000)
+    watcher = bcc.StateWatcher(shared_memory)
+    results["watcher_poll"] = measure(watcher.poll, max_runs=100000)
+    snapshot = bcc.read_cockpit_snapshot(shared_memory)
+    state = bcc.CockpitState.from_snapshot(snapshot)
+    results["cockpit_decode"] = measure(lambda: bcc.CockpitState.from_snapshot(bcc.read_cockpit_snapshot(shared_memory)),
+        max_runs=100000)
+    changed = bcc.CockpitState(state[:1] + (state[1] ^ 0x2010000,) + state[2:])
+    results["cockpit_diff"] = measure(lambda: state.diff(changed), max_runs=100000)
+    shared_memory.release()
+    return results
+
+def bench_randomize(workdir, directory, size):
+    path = os.path.join(workdir, "randomize.key")
+    with open(path, "wb") as keyfile:
+        keyfile.write(generate_keyfile(size, seed=1))
+    write_shared_memory(directory, path)
+    bcc.shared_memory = bcc.SharedMemory(directory)
+    bcc.keyfile_cache = bcc.KeyfileCache(os.path.join(workdir, "cache.json"))
+    results = {"process_keyfile": measure(bcc.process_keyfile, max_runs=1)}
+    results["process_keyfile_cached"] = measure(bcc.process_keyfile, max_runs=100)
+    keyfile_path, analysis = bcc.process_keyfile()
+
+    backend = bcc.RecordingBackend()
+    bcc.input_engine = bcc.InputEngine(backend)
+    panels = []
+    start = time.perf_counter()
+    plan = bcc.randomize_cockpit(analysis, verify=False, on_panel=lambda panel, elapsed: panels.append(elapsed))
+    elapsed = time.perf_counter() - start
+    presses = len(plan.presses)
+    results["randomize_cockpit"] = {
+        "median": elapsed,
+        "min": elapsed,
+        "runs": 1,
+        "keys": presses,
+        "edges": backend.edges,
+        "calls": backend.calls,
+        "keys_per_second": presses / elapsed if elapsed else None,
+        "first_panel": panels[0] if panels else None,
+    }
+    bcc.shared_memory.release()
+    return results
+
+def bench_session(path):
+    """Replay a recorded session frame by frame and poll after every frame."""
+    def replay():
+        # at speed 0 only the frames at the very start are applied by the replay clock
+        replay = bcc.ReplaySharedMemory(path, speed=0)
+        watcher = bcc.StateWatcher(replay)
+        while replay.step():
+            watcher.poll()
+        replay.close()
+        return len(replay.index)
+    result = measure(replay, max_runs=100)
+    result["frames"] = replay()
+    return {"session_replay": result}
+
+def compare(results, baseline, tolerance):
+    """Print the comparison to a baseline and return the names of regressions."""
+    regressions = []
+    for name, result in sorted(results.items()):
+        previous = baseline.get(name)
+        if previous is None:
+            print("{:32} {:12.6f}s  (new)".format(name, result["median"]))
+            continue
+        ratio = result["median"] / previous["median"] if previous["median"] else 1
+        mark = ""
+        if ratio > 1 + tolerance:
+            mark = "REGRESSION"
+            regressions.append(name)
+        print("{:32} {:12.6f}s  {:6.2f}x {}".format(name, result["median"], ratio, mark))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Falcon-BCC benchmarks")
+    parser.add_argument("-o", "--output", help="write the results to this JSON file")
+    parser.add_argument("-b", "--baseline", help="compare the results to this JSON file")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.25,
+        help="allowed slowdown compared to the baseline (default: 0.25)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+        help="keyfile sizes in lines")
+    parser.add_argument("--quick", action="store_true", help="skip the end-to-end randomization")
+    parser.add_argument("--session", metavar="PATH",
+        help="also replay this recording of the shared memory (see falcon-bcc.py --record)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show Falcon-BCC's messages")
+    arguments = parser.parse_args()
+    if not arguments.verbose:
+        bcc.notify = lambda message: None
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="falcon-bcc-bench-") as workdir:
+        directory = os.path.join(workdir, "shm")
+        os.mkdir(directory)
+        write_shared_memory(directory, os.path.join(workdir, "none.key"))
+        results.update(bench_keyfiles(workdir, arguments.sizes))
+        results.update(bench_shared_memory(directory))
+        if not arguments.quick:
+            results.update(bench_randomize(workdir, directory, 2000))
+        if arguments.session:
+            results.update(bench_session(arguments.session))
+
+    regressions = []
+    if arguments.baseline:
+        with open(arguments.baseline, "r") as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+        regressions = compare(results, baseline, arguments.tolerance)
+    else:
+        for name, result in sorted(results.items()):
+            print("{:32} {:12.6f}s".format(name, result["median"]))
+
+    if arguments.output:
+        report = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.time(),
+            "results": results,
+        }
+        with open(arguments.output, "w") as output:
+            json.dump(report, output, indent=2)
+    if regressions:
+        print("Regressions: {}".format(", ".join(regressions)))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -20,16 +20,36 @@
 # with comments
 
 import ctypes
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import fnmatch
+import glob
+import hashlib
+import json
 import struct
 import mmap
+import operator
+import os
+import platform
 import sys
 import time
 import random
-import winsound
-import itertools
 import shutil
+import socket
+import tempfile
+import threading
+
+try:
+    import winsound
+except ImportError:
+    # not on Windows; only useful with file-backed shared memory (see SharedMemory)
+    winsound = None
 
 REFRESH_FREQUENCY = 2
+# polling interval while a randomization could be triggered at any moment
+FAST_REFRESH_FREQUENCY = 0.05
 REQUIRED_CALLBACKS = [
     "SimProbeHeatOn", "SimProbeHeatOff", "SimProbeHeatTest",
     "SimDigitalBUP", "SimAltFlaps", "SimManualFlyup", "SimLEFLockSwitch",
@@ -37,7 +57,7 @@ REQUIRED_CALLBACKS = [
     "SimToggleMasterFuel", "SimFuelPumpOff", "SimFuelPumpNorm", "SimFuelPumpAft", "SimFuelPumpFwd", "SimFuelDoorToggle",
     "SimIFFMasterOff", "SimIFFMasterStby", "SimIFFMasterLow", "SimIFFMasterNorm", "SimIFFMasterEmerg", "SimToggleAuxComMaster",
     "SimIFFMode4ReplyCycle", "SimIFFMode4MonitorToggle", "SimToggleAuxComAATR", "SimIFFEnableCycle",
-    "SimExtlAntiColl", "SimAntiColModeOff", "SimAntiColMode1", "SimAntiColMode2", "SimAntiColMode3", "SimAntiColMode4", "SimAntiColModeA"
+    "SimExtlAntiColl", "SimAntiColModeOff", "SimAntiColMode1", "SimAntiColMode2", "SimAntiColMode3", "SimAntiColMode4", "SimAntiColModeA",
     "SimAntiColModeB", "SimAntiColModeC", "SimExtlSteady", "SimWingLightCycle", "SimFuselageLightCycle", "SimExtlPower", "SimStepAARLightsUp", "SimStepAARLightsDown",
     "SimEpuToggle",
     "SimAVTRSwitch",
@@ -65,6 +85,8 @@ REQUIRED_CALLBACKS = [
     "SimDLPower", "SimMIDSLVTOff", "SimMIDSLVTOn", "SimMAPPower",
 ]
 
+UNASSIGNED_KEY = "0XFFFFFFFF"
+
 KEYBOARD_SCANCODES = [
     "0X2", #1
     "0X3", #2
@@ -372,25 +394,650 @@ class Strings():
         "NavPoint",
         "ThrTerrdatadir"
     ]
+    header = struct.Struct("3I")
+    entry = struct.Struct("2I")
+
+    def __init__(self, data=b"", offsets=None):
+        # the strings are only decoded from data once they're accessed
+        self.data = data
+        self.offsets = offsets or {}
+
+    def __getattr__(self, id):
+        if id not in Strings.id:
+            raise AttributeError(id)
+        offset, length = self.offsets.get(id, (0, 0))
+        value = self.data[offset:offset + length].decode("utf-8", "replace").rstrip("\x00")
+        self.add(id, value)
+        return value
 
     def add(self, id, value):
         setattr(self, id, value)
 
-def read_shared_memory(structure):
-    """Reads the Falcon BMS shared memory
+    @classmethod
+    def parse(cls, buffer):
+        """Parse the string area in a single pass
+
+        Only the header and the entries are read; the string data is copied out of
+        the buffer, but not decoded."""
+        view = memoryview(buffer)
+        try:
+            version_num, num_strings, data_size = cls.header.unpack_from(view, 0)
+            offset = cls.header.size
+            offsets = {}
+            for index in range(min(num_strings, len(cls.id))):
+                str_id, str_length = cls.entry.unpack_from(view, offset)
+                offset += cls.entry.size
+                if str_id < len(cls.id):
+                    offsets[cls.id[str_id]] = (offset, str_length)
+                offset += str_length + 1
+            if offset > len(view):
+                raise ValueError("string area truncated")
+            return cls(bytes(view[:offset]), offsets)
+        finally:
+            view.release()
+
+class Projection():
+    """Precompiled reader for a few fields of a shared memory structure
 
-    Returns data from a shared memory area after passing the appropriate
-    ctype structure (FlightData, FlightData2 or IntellivibeData).
+    The offsets of the requested fields are taken from the ctypes definition once
+    and compiled into a struct.Struct which unpacks only those bytes, instead of
+    decoding the whole structure on every poll. Reading returns a namedtuple with
+    the fields as attributes; the elements of a numeric array field are separate
+    attributes, numbered after the field (ecmBits0, ecmBits1, ...).
     """
-    try:
-        sm = mmap.mmap(-1, ctypes.sizeof(structure), structure.name, access=mmap.ACCESS_READ)
-        buffer = sm.read(ctypes.sizeof(structure))
-        data = structure.from_buffer_copy(buffer)
-        sm.close()
-        return data
-    except Exception as e:
-        print("Error reading shared memory '{}': {}".format(structure.name, e))
-        return None
+
+    def __init__(self, structure, fields):
+        self.structure = structure
+        types = dict(structure._fields_)
+        descriptors = sorted(((getattr(structure, name), name) for name in fields), key=lambda x: x[0].offset)
+        layout = "@"
+        position = 0
+        names = []
+        for descriptor, name in descriptors:
+            if descriptor.offset > position:
+                layout += "{}x".format(descriptor.offset - position)
+            if struct.calcsize(layout) != descriptor.offset:
+                raise ValueError("{}.{}: projected offset {} doesn't match offsetof {}".format(
+                    structure.__name__, name, struct.calcsize(layout), descriptor.offset))
+            layout += struct_code(types[name])
+            names.extend(element_names(name, types[name]))
+            position = descriptor.offset + descriptor.size
+            if struct.calcsize(layout) != position:
+                raise ValueError("{}.{}: projected size doesn't match sizeof {}".format(
+                    structure.__name__, name, descriptor.size))
+        self.struct = struct.Struct(layout)
+        if self.struct.size > ctypes.sizeof(structure):
+            raise ValueError("{}: projection size {} exceeds sizeof {}".format(
+                structure.__name__, self.struct.size, ctypes.sizeof(structure)))
+        self.fields = collections.namedtuple(structure.__name__ + "Fields", names)
+
+    def read(self, buffer):
+        """Unpack the projected fields from a buffer holding the structure."""
+        return self.fields._make(self.struct.unpack_from(buffer))
+
+def array_element(ctype):
+    """Return the element type of a (multidimensional) ctypes array."""
+    element = ctype._type_
+    while issubclass(element, ctypes.Array):
+        element = element._type_
+    return element
+
+def struct_code(ctype):
+    """Return the struct format code for a ctypes field type
+
+    Simple types, character arrays (read as bytes) and arrays of simple types are
+    supported."""
+    if issubclass(ctype, ctypes.Array):
+        element = array_element(ctype)
+        if element is ctypes.c_char:
+            return "{}s".format(ctypes.sizeof(ctype))
+        if issubclass(element, ctypes.Structure):
+            raise TypeError("can't project array of {}".format(element.__name__))
+        return "{}{}".format(ctypes.sizeof(ctype) // ctypes.sizeof(element), element._type_)
+    return ctype._type_
+
+def element_names(name, ctype):
+    """Return the attribute names of a projected field; see Projection."""
+    if not issubclass(ctype, ctypes.Array) or array_element(ctype) is ctypes.c_char:
+        return [name]
+    return ["{}{}".format(name, index) for index in range(ctypes.sizeof(ctype) // ctypes.sizeof(array_element(ctype)))]
+
+def projectable_fields(structure):
+    """Return the names of the fields of a structure which can be projected."""
+    fields = []
+    for name, ctype in structure._fields_:
+        try:
+            struct_code(ctype)
+        except TypeError:
+            continue
+        fields.append(name)
+    return fields
+
+def check_projections(*structures):
+    """Check the struct layout against ctypes for every projectable field
+
+    Compiles a projection over all the supported fields of each structure, which
+    raises ValueError if an offset or size doesn't match offsetof/sizeof."""
+    for structure in structures:
+        Projection(structure, projectable_fields(structure))
+
+FLIGHTDATA_READER = Projection(FlightData, ["MainPower"])
+FLIGHTDATA2_READER = Projection(FlightData2, ["cmdsMode"])
+INTELLIVIBE_READER = Projection(IntellivibeData, ["In3D", "IsOnGround", "IsEndFlight", "IsPaused"])
+STRING_AREA_READER = Projection(FlightData2, ["StringAreaSize", "StringAreaTime"])
+
+class SharedMemory():
+    """Long-lived mappings of the Falcon BMS shared memory areas
+
+    Every area is mapped once and the projections read their fields straight from
+    the mapping, instead of mapping, copying and unmapping it on every poll. An area is only
+    remapped after it disappeared or after release() was called (the sim restarted).
+
+    By default the named Windows mappings are used; they're only opened once the
+    sim created them. Since our own handle would keep a mapping alive after the
+    sim exited, the string area is dropped on every refresh() and opened again,
+    which fails once the sim is gone; the parsed strings are kept meanwhile. If a
+    directory is passed, each area is instead a file in it, named after the area
+    (FalconSharedMemoryArea, ...), which makes it possible to use it on Linux as
+    well.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        # area name -> (mmap, file identity)
+        self.areas = {}
+        # areas which couldn't be mapped; the error is only printed once
+        self.failing = set()
+        # area name -> MappingProbe of the named Windows mapping
+        self.probes = {}
+        # the last parsed string area and its (StringAreaSize, StringAreaTime)
+        self.strings_cache = None
+        self.strings_stamp = None
+
+    def _map(self, name, size):
+        # ACCESS_COPY never writes anything back into the sim's memory
+        if self.directory is None:
+            probe = self.probes.get(name)
+            if probe is None:
+                probe = self.probes[name] = MappingProbe(name)
+            # mmap would create a mapping which doesn't exist yet instead of failing
+            if not probe():
+                raise FileNotFoundError("not created by Falcon BMS")
+            return mmap.mmap(-1, size, name, access=mmap.ACCESS_COPY), None
+        path = os.path.join(self.directory, name)
+        with open(path, "rb") as area_file:
+            stat = os.fstat(area_file.fileno())
+            size = min(size, stat.st_size)
+            mapping = mmap.mmap(area_file.fileno(), size, access=mmap.ACCESS_COPY)
+        return mapping, (stat.st_dev, stat.st_ino)
+
+    def _disappeared(self, name, identity):
+        """Return True if a file-backed area was removed or replaced
+
+        The named string area (without an identity) always counts as gone, so
+        that our handle doesn't keep it alive; see refresh()."""
+        if identity is None:
+            return name == Strings.name
+        try:
+            stat = os.stat(os.path.join(self.directory, name))
+        except OSError:
+            return True
+        return (stat.st_dev, stat.st_ino) != identity
+
+    def buffer(self, name, size):
+        """Return the mapping of an area, mapping it if necessary
+
+        Returns None if the area can't be mapped."""
+        area = self.areas.get(name)
+        if area is not None:
+            return area[0]
+        try:
+            mapping, identity = self._map(name, size)
+        except Exception as e:
+            if name not in self.failing:
+                self.failing.add(name)
+                print("Error reading shared memory '{}': {}".format(name, e))
+            return None
+        self.failing.discard(name)
+        self.areas[name] = (mapping, identity)
+        return mapping
+
+    def read(self, projection):
+        """Read the fields of a projection from its area
+
+        Returns a namedtuple with the projected fields or None if the area isn't
+        available."""
+        structure = projection.structure
+        mapping = self.buffer(structure.name, ctypes.sizeof(structure))
+        if mapping is None:
+            return None
+        try:
+            with instrumentation.timer("shm_read"):
+                return projection.read(mapping)
+        except (struct.error, ValueError) as e:
+            # ValueError: the mapping was closed by refresh() in another thread
+            print("Error reading shared memory '{}': {}".format(structure.name, e))
+            return None
+
+    def strings(self):
+        """Read the string area
+
+        Returns an instance of the Strings class or None if the area isn't
+        available. The area is only parsed again once FlightData2.StringAreaTime or
+        StringAreaSize change; without those (StringAreaTime is 0) it's parsed on
+        every call. It's mapped either way, which tells whether it still exists."""
+        sm = self.buffer(Strings.name, Strings.area_size_max)
+        if sm is None:
+            return None
+        stamp = self.read(STRING_AREA_READER)
+        if stamp is not None and stamp.StringAreaTime and stamp == self.strings_stamp:
+            return self.strings_cache
+        try:
+            strings = Strings.parse(sm)
+        except Exception as e:
+            print("Error reading shared memory '{}': {}".format(Strings.name, e))
+            return None
+        self.strings_cache = strings
+        self.strings_stamp = stamp
+        return strings
+
+    def refresh(self):
+        """Drop the mappings of areas which disappeared, so they get remapped
+
+        The named string area is always dropped and probed again once it's used;
+        its parsed strings stay valid as long as the stamp matches (see
+        strings())."""
+        for name, (mapping, identity) in list(self.areas.items()):
+            if self._disappeared(name, identity):
+                self.release(name, keep_strings=identity is None)
+
+    def release(self, name=None, keep_strings=False):
+        """Unmap one area or all of them if no name is passed
+
+        The parsed strings are forgotten with the string area, unless
+        keep_strings is set. Mappings returned by buffer() earlier must not be
+        used afterwards."""
+        names = [name] if name else list(self.areas)
+        for name in names:
+            area = self.areas.pop(name, None)
+            if area is None:
+                continue
+            mapping, identity = area
+            if name == Strings.name and not keep_strings:
+                self.strings_cache = self.strings_stamp = None
+            self._unmap(mapping)
+
+    def _unmap(self, mapping):
+        try:
+            mapping.close()
+        except BufferError:
+            # a memoryview of it is still in use; it's closed once that's gone
+            pass
+
+# areas captured by the recorder, in the order of their index in a recording
+RECORDED_AREAS = [FlightData, FlightData2, IntellivibeData, Strings]
+RECORDING_MAGIC = b"FBCCSHM1"
+RECORDING_HEADER = struct.Struct("<8sdH")
+RECORDING_AREA = struct.Struct("<HI")
+RECORDING_FRAME = struct.Struct("<dBH")
+RECORDING_RUN = struct.Struct("<II")
+
+class SharedMemoryRecorder():
+    """Records the shared memory areas into an append-only log
+
+    The log starts with a header (RECORDING_MAGIC, the wall clock time of the
+    start, and the name and size of every recorded area). Each frame is the time
+    since the start, the index of the area and the runs of bytes which changed
+    since the previous frame of that area, as (offset, length) followed by the
+    bytes. Areas which didn't change aren't written at all, so the size of the log
+    grows with the rate of change rather than the frame rate. The string area is
+    only captured after it was parsed again; see SharedMemory.strings().
+    """
+    block = 64
+
+    def __init__(self, path, shared_memory, rate=10):
+        self.shared_memory = shared_memory
+        self.interval = 1 / rate
+        self.previous = [b""] * len(RECORDED_AREAS)
+        self.frames = 0
+        self.started = time.perf_counter()
+        self.file = open(path, "wb")
+        header = RECORDING_HEADER.pack(RECORDING_MAGIC, time.time(), len(RECORDED_AREAS))
+        for structure in RECORDED_AREAS:
+            name = structure.name.encode("ascii")
+            size = Strings.area_size_max if structure is Strings else ctypes.sizeof(structure)
+            header += RECORDING_AREA.pack(len(name), size) + name
+        self.file.write(header)
+
+    def capture(self):
+        """Append a frame of every area which changed since the last capture."""
+        now = time.perf_counter() - self.started
+        frames = []
+        for index, structure in enumerate(RECORDED_AREAS):
+            if structure is Strings:
+                strings = self.shared_memory.strings()
+                data = strings.data if strings is not None else None
+            else:
+                mapping = self.shared_memory.buffer(structure.name, ctypes.sizeof(structure))
+                data = mapping[:ctypes.sizeof(structure)] if mapping is not None else None
+            if data is None or data is self.previous[index]:
+                continue
+            runs = self.diff(self.previous[index], data)
+            self.previous[index] = data
+            if runs:
+                frames.append(RECORDING_FRAME.pack(now, index, len(runs)))
+                for offset, chunk in runs:
+                    frames.append(RECORDING_RUN.pack(offset, len(chunk)))
+                    frames.append(chunk)
+                self.frames += 1
+        if frames:
+            self.file.write(b"".join(frames))
+
+    def diff(self, previous, data):
+        """Return the (offset, bytes) runs of data which differ from previous
+
+        Compares blocks of the data and merges adjacent changed blocks into a
+        single run."""
+        runs = []
+        block = self.block
+        start = None
+        for offset in range(0, len(data), block):
+            if data[offset:offset + block] != previous[offset:offset + block]:
+                if start is None:
+                    start = offset
+            elif start is not None:
+                runs.append((start, data[start:offset]))
+                start = None
+        if start is not None:
+            runs.append((start, data[start:]))
+        return runs
+
+    async def run(self):
+        """Capture frames at the recording rate until cancelled."""
+        try:
+            while True:
+                self.capture()
+                await asyncio.sleep(self.interval)
+        finally:
+            self.close()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+            notify("Recorded {} frame(s)".format(self.frames))
+
+class ReplaySharedMemory(SharedMemory):
+    """Serves a recorded log through the SharedMemory interface
+
+    The log is mapped and indexed once; every area is a buffer the frames are
+    applied to in place, so the areas stay live like the real mappings. The frames are applied as the replay time passes, at `speed` times
+    the recorded speed. Once the last frame was played, the areas become
+    unavailable, as if the sim had stopped.
+    """
+
+    def __init__(self, path, speed=1.0):
+        super().__init__()
+        self.speed = speed
+        with open(path, "rb") as log_file:
+            self.log = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.recorded_at, count = RECORDING_HEADER.unpack_from(self.log, 0)
+        if magic != RECORDING_MAGIC:
+            raise ValueError("{} isn't a Falcon-BCC recording".format(path))
+        offset = RECORDING_HEADER.size
+        self.names = []
+        self.frames = {}
+        for index in range(count):
+            length, size = RECORDING_AREA.unpack_from(self.log, offset)
+            offset += RECORDING_AREA.size
+            name = self.log[offset:offset + length].decode("ascii")
+            offset += length
+            self.names.append(name)
+            self.frames[name] = bytearray(size)
+        self.index = self.scan(offset)
+        self.position = 0
+        self.started = None
+
+    def scan(self, offset):
+        """Return the (time, offset) of every complete frame in the log."""
+        index = []
+        end = len(self.log)
+        while offset + RECORDING_FRAME.size <= end:
+            timestamp, area, runs = RECORDING_FRAME.unpack_from(self.log, offset)
+            frame = offset
+            offset += RECORDING_FRAME.size
+            for run in range(runs):
+                if offset + RECORDING_RUN.size > end:
+                    return index
+                offset += RECORDING_RUN.size + RECORDING_RUN.unpack_from(self.log, offset)[1]
+            if offset > end:
+                # the recording was interrupted in the middle of a frame
+                break
+            index.append((timestamp, frame))
+        return index
+
+    @property
+    def finished(self):
+        return self.position >= len(self.index)
+
+    def advance(self):
+        """Apply the frames up to the current replay time
+
+        The replay time starts at the first frame, so the frames recorded at the
+        very start are applied on the first call."""
+        if self.started is None:
+            self.started = time.perf_counter()
+        start = self.index[0][0] if self.index else 0
+        now = start + (time.perf_counter() - self.started) * self.speed
+        while self.position < len(self.index) and self.index[self.position][0] <= now:
+            self.step()
+
+    def step(self):
+        """Apply the next frame regardless of the replay time
+
+        Returns False if there are no frames left."""
+        if self.finished:
+            return False
+        self.apply(self.index[self.position][1])
+        self.position += 1
+        return True
+
+    def apply(self, offset):
+        timestamp, area, runs = RECORDING_FRAME.unpack_from(self.log, offset)
+        buffer = self.frames[self.names[area]]
+        offset += RECORDING_FRAME.size
+        for run in range(runs):
+            start, length = RECORDING_RUN.unpack_from(self.log, offset)
+            offset += RECORDING_RUN.size
+            buffer[start:start + length] = self.log[offset:offset + length]
+            offset += length
+
+    def _map(self, name, size):
+        if name not in self.frames:
+            raise OSError("area not recorded")
+        return self.frames[name], None
+
+    def _disappeared(self, name, identity):
+        return False
+
+    def _unmap(self, mapping):
+        pass
+
+    def buffer(self, name, size):
+        self.advance()
+        if self.finished:
+            return None
+        return super().buffer(name, size)
+
+    def close(self):
+        self.release()
+        self.log.close()
+
+# Unix sockets aren't available on every platform (e.g. Windows)
+AF_UNIX = getattr(socket, "AF_UNIX", None)
+
+def telemetry_address(text):
+    """Parse a --publish address: "udp:HOST:PORT" or "unix:PATH"."""
+    kind, _, target = text.partition(":")
+    if kind == "unix" and target:
+        if AF_UNIX is None:
+            raise argparse.ArgumentTypeError("unix sockets aren't supported on this platform")
+        return AF_UNIX, target
+    if kind == "udp":
+        host, _, port = target.rpartition(":")
+        if host and port.isdigit():
+            return socket.AF_INET, (host, int(port))
+    raise argparse.ArgumentTypeError("expected udp:HOST:PORT or unix:PATH, not {!r}".format(text))
+
+class TelemetryPublisher():
+    """Publishes the shared memory to other programs over a datagram socket
+
+    Every tick, the areas which changed are decoded once (all their projectable
+    fields, named Area.field, e.g. FlightData2.cmdsMode or Strings.KeyFile) and the
+    changed fields are sent to the subscribers as JSON: {"seq": n, "full": false,
+    "fields": {...}}. A subscriber sends {"subscribe": [patterns]} with fnmatch
+    patterns of the fields it wants and first gets all of them ("full": true). It
+    has to subscribe again within `expiry` seconds to stay subscribed, or can
+    send {"unsubscribe": true}. Messages are split to stay below max_message bytes.
+    """
+    areas = [FlightData, FlightData2, IntellivibeData]
+    max_message = 60000
+
+    def __init__(self, address, shared_memory, rate=20, expiry=30):
+        self.family, self.address = address
+        self.shared_memory = shared_memory
+        self.interval = 1 / rate
+        self.expiry = expiry
+        self.socket = socket.socket(self.family, socket.SOCK_DGRAM)
+        if self.family == AF_UNIX and os.path.exists(self.address):
+            os.unlink(self.address)
+        self.socket.bind(self.address)
+        self.socket.setblocking(False)
+        self.projections = [(structure, Projection(structure, projectable_fields(structure))) for structure in self.areas]
+        self.names = {structure: ["{}.{}".format(structure.__name__, field) for field in projection.fields._fields]
+            for structure, projection in self.projections}
+        self.raw = {}
+        self.strings = None
+        self.values = {}
+        # address -> [set of field names, time of the last subscription, whether
+        # it still needs all the fields]
+        self.subscribers = {}
+        self.seq = 0
+
+    def read(self):
+        """Decode the areas which changed; returns the names of the changed fields."""
+        changed = []
+        for structure, projection in self.projections:
+            mapping = self.shared_memory.buffer(structure.name, ctypes.sizeof(structure))
+            if mapping is None:
+                continue
+            raw = mapping[:ctypes.sizeof(structure)]
+            if raw == self.raw.get(structure):
+                continue
+            self.raw[structure] = raw
+            for name, value in zip(self.names[structure], projection.read(raw)):
+                if isinstance(value, bytes):
+                    value = value.decode("latin-1").rstrip("\x00")
+                if name not in self.values or self.values[name] != value:
+                    self.values[name] = value
+                    changed.append(name)
+        strings = self.shared_memory.strings()
+        if strings is not None and strings is not self.strings:
+            self.strings = strings
+            for id in Strings.id:
+                name = "Strings." + id
+                value = getattr(strings, id)
+                if self.values.get(name) != value:
+                    self.values[name] = value
+                    changed.append(name)
+        return changed
+
+    def receive(self):
+        """Handle the pending (un)subscriptions."""
+        now = time.monotonic()
+        while True:
+            try:
+                data, address = self.socket.recvfrom(65536)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                # e.g. a subscriber's port was closed (Windows reports it here)
+                continue
+            try:
+                request = json.loads(data.decode("utf-8"))
+                if request.get("unsubscribe"):
+                    self.subscribers.pop(address, None)
+                    continue
+                patterns = [str(pattern) for pattern in request["subscribe"]]
+            except (ValueError, KeyError, TypeError, AttributeError):
+                continue
+            subscriber = self.subscribers.get(address)
+            fields = {name for name in self.all_names() if any(fnmatch.fnmatchcase(name, p) for p in patterns)}
+            full = subscriber is None or subscriber[0] != fields or subscriber[2]
+            self.subscribers[address] = [fields, now, full]
+        for address, (fields, seen, full) in list(self.subscribers.items()):
+            if now - seen > self.expiry:
+                del self.subscribers[address]
+
+    def all_names(self):
+        names = ["Strings." + id for id in Strings.id]
+        for structure in self.areas:
+            names.extend(self.names[structure])
+        return names
+
+    def send(self, address, names, full=False):
+        fields = {name: self.values[name] for name in sorted(names)}
+        for message in self.encode(fields, full):
+            try:
+                self.socket.sendto(message, address)
+            except OSError:
+                # gone without unsubscribing; it expires
+                return
+
+    def encode(self, fields, full):
+        """Return the JSON messages holding the fields, split if necessary."""
+        self.seq += 1
+        message = json.dumps({"seq": self.seq, "full": full, "fields": fields}).encode("utf-8")
+        if len(message) <= self.max_message or len(fields) < 2:
+            return [message]
+        names = list(fields)
+        half = len(names) // 2
+        return (self.encode({name: fields[name] for name in names[:half]}, full)
+            + self.encode({name: fields[name] for name in names[half:]}, full))
+
+    def tick(self):
+        self.receive()
+        if not self.subscribers:
+            return
+        changed = set(self.read())
+        for address, subscriber in list(self.subscribers.items()):
+            fields, seen, full = subscriber
+            if full:
+                subscriber[2] = False
+                self.send(address, fields & self.values.keys(), full=True)
+            elif fields & changed:
+                self.send(address, fields & changed)
+
+    async def run(self):
+        """Publish at the tick rate until cancelled."""
+        try:
+            while True:
+                with instrumentation.timer("publish"):
+                    self.tick()
+                await asyncio.sleep(self.interval)
+        finally:
+            self.close()
+
+    def close(self):
+        if self.socket.fileno() == -1:
+            return
+        self.socket.close()
+        if self.family == AF_UNIX:
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+
+shared_memory = SharedMemory()
 
 def read_shared_memory_strings():
     """Reads the string area of the Falcon BMS shared memory
@@ -398,26 +1045,10 @@ def read_shared_memory_strings():
     Returns an instance of the Strings class holding all the available strings
     as object attributes.
     """
-    try:
-        sm = mmap.mmap(-1, Strings.area_size_max, Strings.name, access=mmap.ACCESS_READ)
-        version_num = struct.unpack('I', sm.read(4))[0]
-        num_strings = struct.unpack('I', sm.read(4))[0]
-        data_size = struct.unpack('I', sm.read(4))[0]
-        instance = Strings()
-        for id in Strings.id:
-            str_id = struct.unpack('I', sm.read(4))[0]
-            str_length = struct.unpack('I', sm.read(4))[0]
-            str_data = sm.read(str_length + 1).decode('utf-8').rstrip('\x00')
-            instance.add(id, str_data)
-        sm.close()
-        return instance
-    except Exception as e:
-        print("Error reading shared memory '{}': {}".format(Strings.name, e))
-        return None
+    return shared_memory.strings()
 
 # generating keyboard events; see https://stackoverflow.com/a/23468236
 # <--- start license: Attribution-ShareAlike 3.0 Unported (CC BY-SA 3.0)
-SendInput = ctypes.windll.user32.SendInput
 PUL = ctypes.POINTER(ctypes.c_ulong)
 class KeyBdInput(ctypes.Structure):
     _fields_ = [("wVk", ctypes.c_ushort),
@@ -448,200 +1079,1028 @@ class Input(ctypes.Structure):
     _fields_ = [("type", ctypes.c_ulong),
                 ("ii", Input_I)]
 
-def PressKey(hexKeyCode):
-    extra = ctypes.c_ulong(0)
-    ii_ = Input_I()
-    ii_.ki = KeyBdInput( 0, hexKeyCode, 0x0008, 0, ctypes.pointer(extra) )
-    x = Input( ctypes.c_ulong(1), ii_ )
-    ctypes.windll.user32.SendInput(1, ctypes.pointer(x), ctypes.sizeof(x))
-
-def ReleaseKey(hexKeyCode):
-    extra = ctypes.c_ulong(0)
-    ii_ = Input_I()
-    ii_.ki = KeyBdInput( 0, hexKeyCode, 0x0008 | 0x0002, 0, ctypes.pointer(extra) )
-    x = Input( ctypes.c_ulong(1), ii_ )
-    ctypes.windll.user32.SendInput(1, ctypes.pointer(x), ctypes.sizeof(x))
+KEYEVENTF_SCANCODE = 0x0008
+KEYEVENTF_KEYUP = 0x0002
+
+class SendInputBackend():
+    """Injects keyboard events with SendInput (Windows only)
+
+    Every packet is a preallocated Input array holding all the edges of one step,
+    so a step is submitted with a single SendInput call."""
+
+    def __init__(self):
+        self.send_input = ctypes.windll.user32.SendInput
+        self.send_input.argtypes = (ctypes.c_uint, ctypes.POINTER(Input), ctypes.c_int)
+        self.extra = ctypes.c_ulong(0)
+
+    def prepare(self, edges):
+        packet = (Input * len(edges))()
+        for item, (scancode, release) in zip(packet, edges):
+            flags = KEYEVENTF_SCANCODE | KEYEVENTF_KEYUP if release else KEYEVENTF_SCANCODE
+            item.type = 1
+            item.ii.ki = KeyBdInput(0, scancode, flags, 0, ctypes.pointer(self.extra))
+        return packet
+
+    def submit(self, packet):
+        return self.send_input(len(packet), packet, ctypes.sizeof(Input))
 # end CC BY-SA 3.0 license--->
 
-def send_key(key, modifier):
-    # TODO: look into this some more
-    # the key is passed as a hex string, but it expects an int
-    keycode = int(key, 16)
-    # without a delay, it seems to fail when a bunch of modifiers are pressed
-    # TODO: fix the ugly delays for complex modifier buttons
-    # complex modifier combons (ctrl+alt+shift) seemed to have issues
-    delay = 0.01
-    if modifier == "0":
-        PressKey(keycode)
-        time.sleep(delay)
-        ReleaseKey(keycode)
-    elif modifier == "1":
-        PressKey(0x2a)
-        PressKey(keycode)
-        time.sleep(delay)
-        ReleaseKey(keycode)
-        ReleaseKey(0x2a)
-    elif modifier == "2":
-        PressKey(0x1d)
-        PressKey(keycode)
-        time.sleep(delay)
-        ReleaseKey(keycode)
-        ReleaseKey(0x1d)
-    elif modifier == "3":
-        PressKey(0x1d)
-        time.sleep(delay)
-        PressKey(0x2a)
-        time.sleep(delay)
-        PressKey(keycode)
-        time.sleep(delay)
-        ReleaseKey(keycode)
-        ReleaseKey(0x2a)
-        ReleaseKey(0x1d)
-    elif modifier == "4":
-        PressKey(0x38 + 2048)
-        time.sleep(delay)
-        PressKey(keycode)
-        time.sleep(delay)
-        ReleaseKey(keycode)
-        ReleaseKey(0x38 + 2048)
-# Alt+Shift modifier removed; see get_unused_keys()
-#    elif modifier == "5":
-#        PressKey(0x38 + 2048)
-#        time.sleep(delay)
-#        PressKey(0x2a)
-#        PressKey(keycode)
-#        time.sleep(delay)
-#        ReleaseKey(keycode)
-#        ReleaseKey(0x2a)
-#        ReleaseKey(0x38 + 2048)
-    elif modifier == "6":
-        PressKey(0x1d)
-        time.sleep(delay)
-        PressKey(0x38 + 2048)
-        time.sleep(delay)
-        PressKey(keycode)
-        time.sleep(delay)
-        ReleaseKey(keycode)
-        ReleaseKey(0x38 + 2048)
-        ReleaseKey(0x1d)
-    elif modifier == "7":
-        PressKey(0x1d)
-        time.sleep(delay)
-        PressKey(0x2a)
-        time.sleep(delay)
-        PressKey(0x38 + 2048)
-        time.sleep(delay)
-        PressKey(keycode)
-        time.sleep(delay)
-        ReleaseKey(keycode)
-        ReleaseKey(0x38 + 2048)
-        ReleaseKey(0x2a)
-        ReleaseKey(0x1d)
+class RecordingBackend():
+    """Records keyboard events instead of injecting them
+
+    Keeps (timestamp, scancode, release) tuples in events, or only counts the
+    calls and edges if keep is False (a null backend). Works on any platform."""
+
+    def __init__(self, keep=True):
+        self.keep = keep
+        self.events = []
+        self.calls = 0
+        self.edges = 0
+
+    def prepare(self, edges):
+        return tuple(edges)
+
+    def submit(self, packet):
+        self.calls += 1
+        self.edges += len(packet)
+        if self.keep:
+            now = time.perf_counter()
+            self.events.extend((now, scancode, release) for scancode, release in packet)
+        return len(packet)
+
+class SocketBackend():
+    """Sends keyboard events to a Unix datagram socket
+
+    Every packet is a datagram of (scancode, release) pairs packed as EDGE, e.g. for
+    the simulated sim of simulator.py."""
+    edge = struct.Struct("<HB")
+
+    def __init__(self, path):
+        self.path = path
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def prepare(self, edges):
+        return b"".join(self.edge.pack(scancode, release) for scancode, release in edges)
+
+    def submit(self, packet):
+        try:
+            self.socket.sendto(packet, self.path)
+        except OSError:
+            # nobody is listening (anymore); like SendInput without a window
+            return 0
+        return len(packet) // self.edge.size
+
+# scancodes held down for each modifier; 0x38 + 2048 is Alt
+MODIFIER_SCANCODES = {
+    "0": (),
+    "1": (0x2a,),
+    "2": (0x1d,),
+    "3": (0x1d, 0x2a),
+    "4": (0x38 + 2048,),
+    # Alt+Shift ("5") removed; see get_unused_keys()
+    "6": (0x1d, 0x38 + 2048),
+    "7": (0x1d, 0x2a, 0x38 + 2048),
+}
+
+InputStep = collections.namedtuple("InputStep", ["packet", "delay", "last", "release", "run"])
+
+class InputEngine():
+    """Compiles key presses into batched input steps and plays them
+
+    A step is a packet of key edges submitted to the backend at once, followed by
+    a delay; last marks the final step of a key press. If modifiers are still
+    held after a key press (in the middle of a run), release is the packet which
+    lets go of them. The first step of a run has the number of its keys in run,
+    the other steps 0. A backend has to provide prepare(edges), turning a list of
+    (scancode, release) tuples into a packet, and submit(packet).
+    """
+
+    def __init__(self, backend, delay=0.01, pacing=None, budget=None):
+        self.backend = backend
+        self.delay = delay
+        self.pacing = pacing
+        # (keys, seconds): at most that many keys per time slice
+        self.budget = budget
+        # runs are held at most for a slice; see schedule_presses()
+        self.max_run = min(16, budget[0]) if budget else 16
+
+    def delay_for(self, modifier):
+        """Return the delay after pressing the modifiers and the key; see KeyPacing."""
+        if self.pacing is None:
+            return self.delay
+        return self.pacing.delay(modifier, self.delay)
+
+    def compile_run(self, modifier, keys):
+        """Compile a run of keys sharing a modifier into a list of InputSteps
+
+        The modifiers are pressed once, held while every key is tapped, and
+        released together with the last key."""
+        modifiers = MODIFIER_SCANCODES.get(modifier)
+        if modifiers is None or not keys:
+            return []
+        prepare = self.backend.prepare
+        delay = self.delay_for(modifier)
+        steps = []
+        released = [(code, True) for code in reversed(modifiers)]
+        release = prepare(released) if modifiers else None
+        if modifiers:
+            # complex modifier combos (ctrl+alt+shift) seemed to have issues if the
+            # key follows the modifiers without a delay
+            steps.append(InputStep(prepare([(code, False) for code in modifiers]), delay, False, None, 0))
+        for index, key in enumerate(keys):
+            # the key is passed as a hex string, but it expects an int
+            keycode = int(key, 16)
+            steps.append(InputStep(prepare([(keycode, False)]), delay, False, None, 0))
+            if index < len(keys) - 1:
+                steps.append(InputStep(prepare([(keycode, True)]), 0, True, release, 0))
+            else:
+                steps.append(InputStep(prepare([(keycode, True)] + released), 0, True, None, 0))
+        steps[0] = steps[0]._replace(run=len(keys))
+        return steps
+
+    def compile_key(self, key, modifier):
+        """Compile a single key press with its modifiers into a list of InputSteps."""
+        return self.compile_run(modifier, [key])
+
+    def compile_schedule(self, runs):
+        """Compile the (modifier, keys) runs of schedule_presses() into a list of InputSteps."""
+        steps = []
+        for modifier, keys in runs:
+            steps.extend(self.compile_run(modifier, keys))
+        return steps
+
+    def play(self, steps, gate=None):
+        """Play the steps
+
+        If a SendGate is passed, it's checked before every run, so nothing is sent
+        while it's paused or once it's aborted, and after every key press, so the
+        sending can be aborted without leaving any key held down. While the
+        modifiers of a run are held, it can only be aborted (which releases them);
+        a pause takes effect at the end of the run. With a budget, the keys of a
+        run are counted against the time slice before the run starts; if they
+        don't fit, the sending waits for the next slice. Returns False if it was
+        aborted."""
+        submit = self.backend.submit
+        measure = instrumentation.enabled
+        started = time.perf_counter()
+        if self.budget is not None:
+            keys, interval = self.budget
+            slice_end = started + interval
+            sent = 0
+        for step in steps:
+            if step.run and self.budget is not None:
+                now = time.perf_counter()
+                if now >= slice_end:
+                    slice_end = now + interval
+                    sent = 0
+                elif sent and sent + step.run > keys:
+                    # a run is never longer than the budget (see max_run), so it fits a new slice
+                    time.sleep(slice_end - now)
+                    slice_end = max(slice_end, time.perf_counter()) + interval
+                    sent = 0
+                sent += step.run
+            if step.run and gate is not None and not gate.proceed():
+                return False
+            submit(step.packet)
+            if step.delay:
+                time.sleep(step.delay)
+            if step.last:
+                if measure:
+                    now = time.perf_counter()
+                    instrumentation.record("send_key", now - started)
+                    started = now
+                if gate is not None and step.release is not None and gate.aborted:
+                    submit(step.release)
+                    return False
+        return True
+
+def schedule_presses(presses, max_run=16):
+    """Group key presses sharing a modifier into runs
+
+    Takes a sequence of presses with control, key and modifier attributes (like
+    PlannedPress) and returns a list of (modifier, keys) runs, each of which is sent
+    with a single press and release of its modifiers. Presses of the same control
+    keep their relative order; presses of different controls are reordered freely.
+    Each run takes the modifier which most controls are waiting on next, and is
+    at most max_run keys long so a pause doesn't wait too long. Raises ValueError
+    if max_run is less than 1."""
+    if max_run < 1:
+        raise ValueError("max_run has to be at least 1, not {}".format(max_run))
+    queues = collections.OrderedDict()
+    for press in presses:
+        queues.setdefault(press.control, collections.deque()).append(press)
+    runs = []
+    while queues:
+        waiting = collections.Counter(queue[0].modifier for queue in queues.values())
+        modifier = max(waiting, key=waiting.get)
+        keys = []
+        for control in list(queues):
+            queue = queues[control]
+            while queue and queue[0].modifier == modifier and len(keys) < max_run:
+                keys.append(queue.popleft().key)
+            if not queue:
+                del queues[control]
+            if len(keys) == max_run:
+                break
+        runs.append((modifier, keys))
+    return runs
+
+class SendGate():
+    """Lets the key sender be paused, resumed or aborted from another thread."""
+
+    def __init__(self):
+        self.running = threading.Event()
+        self.running.set()
+        self.aborted = False
+
+    def pause(self):
+        self.running.clear()
+
+    def resume(self):
+        self.running.set()
+
+    def abort(self):
+        self.aborted = True
+        self.running.set()
+
+    def proceed(self):
+        """Block while paused; return False if aborted."""
+        self.running.wait()
+        return not self.aborted
+
+input_engine = None
 
 def notify(message):
     """Prefix every printed message."""
     print("[Falcon-BCC]: {}".format(message))
 
+def play_sound(playing):
+    """Start or stop the looping sound played while randomizing (Windows only)."""
+    if winsound is None:
+        return
+    if playing:
+        winsound.PlaySound("Notification.Proximity", winsound.SND_ALIAS | winsound.SND_LOOP | winsound.SND_ASYNC)
+    else:
+        winsound.PlaySound(None, winsound.SND_FILENAME)
+
+class Histogram():
+    """Latency histogram with HDR-style buckets
+
+    Values are recorded in nanoseconds into buckets keyed by their power of two and
+    the top `precision` bits below it, which bounds the relative error of every
+    bucket to 2 ** -precision while keeping the memory use tiny."""
+
+    def __init__(self, precision=5):
+        self.precision = precision
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, nanoseconds):
+        shift = max(nanoseconds.bit_length() - self.precision, 0)
+        self.buckets[(shift, nanoseconds >> shift)] += 1
+        self.count += 1
+        self.total += nanoseconds
+        if self.min is None or nanoseconds < self.min:
+            self.min = nanoseconds
+        if self.max is None or nanoseconds > self.max:
+            self.max = nanoseconds
+
+    def percentile(self, percent):
+        """Return the upper bound of the bucket holding the percentile, in nanoseconds."""
+        if not self.count:
+            return 0
+        rank = self.count * percent / 100
+        seen = 0
+        for (shift, mantissa), count in sorted(self.buckets.items(), key=lambda item: item[0][1] << item[0][0]):
+            seen += count
+            if seen >= rank:
+                return min(((mantissa + 1) << shift) - 1, self.max)
+        return self.max
+
+    def summary(self):
+        """Return the count, sum and a few percentiles in seconds."""
+        return {
+            "count": self.count,
+            "sum": self.total / 1e9,
+            "min": (self.min or 0) / 1e9,
+            "max": (self.max or 0) / 1e9,
+            "p50": self.percentile(50) / 1e9,
+            "p90": self.percentile(90) / 1e9,
+            "p99": self.percentile(99) / 1e9,
+        }
+
+class Timer():
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exception):
+        self.histogram.record(time.perf_counter_ns() - self.start)
+
+class NullTimer():
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        pass
+
+class NullInstrumentation():
+    """Instrumentation which doesn't measure anything (the default)."""
+    enabled = False
+    null_timer = NullTimer()
+
+    def timer(self, name):
+        return self.null_timer
+
+    def record(self, name, seconds):
+        pass
+
+    def flush(self, force=False):
+        pass
+
+class Instrumentation():
+    """Collects latency histograms of the phases of Falcon-BCC
+
+    timer(name) returns a context manager timing its block into the histogram with
+    that name; record() adds a measured duration in seconds. The histograms are
+    written to `path` at most every `interval` seconds by flush(), either as JSON
+    or as a Prometheus textfile (format "prometheus")."""
+    enabled = True
+
+    def __init__(self, path=None, format="json", interval=60):
+        self.path = path
+        self.format = format
+        self.interval = interval
+        self.histograms = collections.defaultdict(Histogram)
+        self.flushed = time.monotonic()
+
+    def timer(self, name):
+        return Timer(self.histograms[name])
+
+    def record(self, name, seconds):
+        self.histograms[name].record(int(seconds * 1e9))
+
+    def prometheus(self):
+        lines = []
+        for name, histogram in sorted(self.histograms.items()):
+            metric = "falcon_bcc_{}_seconds".format(name)
+            summary = histogram.summary()
+            lines.append("# TYPE {} summary".format(metric))
+            for quantile, key in (("0.5", "p50"), ("0.9", "p90"), ("0.99", "p99")):
+                lines.append('{}{{quantile="{}"}} {}'.format(metric, quantile, summary[key]))
+            lines.append("{}_sum {}".format(metric, summary["sum"]))
+            lines.append("{}_count {}".format(metric, summary["count"]))
+        return "\n".join(lines) + "\n"
+
+    def flush(self, force=False):
+        """Write the histograms if the interval elapsed (or if forced)."""
+        if not self.path or not force and time.monotonic() - self.flushed < self.interval:
+            return
+        self.flushed = time.monotonic()
+        if self.format == "prometheus":
+            content = self.prometheus()
+        else:
+            metrics = {name: histogram.summary() for name, histogram in sorted(self.histograms.items())}
+            content = json.dumps({"time": time.time(), "metrics": metrics}, indent=2)
+        try:
+            temp_path = "{}.tmp".format(self.path)
+            with open(temp_path, "w") as metrics_file:
+                metrics_file.write(content)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            notify("Warning: couldn't write the metrics: {}".format(e))
+
+instrumentation = NullInstrumentation()
+
+class SamplingProfiler():
+    """Samples the stacks of all threads at a fixed interval
+
+    Used as a context manager around the profiled code. Every thread is sampled,
+    since the planning, sending and verification run in worker threads. The
+    samples are written as collapsed stacks (one "thread;frame;frame count" line
+    per stack, the input of flamegraph tools) and the functions seen most often
+    are printed."""
+
+    def __init__(self, path, interval=0.005):
+        self.path = path
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, name="falcon-bcc-profiler", daemon=True)
+
+    def sample(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{}:{}:{}".format(os.path.basename(code.co_filename), code.co_name, code.co_firstlineno))
+                    frame = frame.f_back
+                if stack:
+                    stack.append(names.get(thread_id, str(thread_id)))
+                    self.stacks[";".join(reversed(stack))] += 1
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exception):
+        self.stopped.set()
+        self.thread.join()
+        with open(self.path, "w") as profile:
+            for stack, count in self.stacks.most_common():
+                profile.write("{} {}\n".format(stack, count))
+        leaves = collections.Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        total = sum(leaves.values())
+        notify("Profile written to: {} ({} samples)".format(self.path, total))
+        for leaf, count in leaves.most_common(10):
+            notify("\t{:5.1f}% {}".format(100 * count / total, leaf))
+
+# keyfile used instead of the one in the shared memory (--keyfile)
+keyfile_override = None
+
 def get_keyfile_path():
     """Get the keyfile path from the shared memory.
 
     Returns a string with the path to the keyfile."""
+    if keyfile_override:
+        notify("Using keyfile: {}".format(keyfile_override))
+        return keyfile_override
     strings = read_shared_memory_strings()
     notify("Using keyfile: {}".format(strings.KeyFile))
     return strings.KeyFile
 
+class KeyBinding():
+    """A keyboard callback line of a keyfile
+
+    Holds the line number in the keyfile, the callback, the keycode (upper case hex)
+    and the modifier, and the tokens of the whole line."""
+    __slots__ = ("number", "callback", "key", "modifier", "tokens")
+
+    def __init__(self, number, tokens):
+        self.number = number
+        self.callback = tokens[0]
+        self.key = tokens[3]
+        self.modifier = tokens[4]
+        self.tokens = tokens
+
+    def __repr__(self):
+        return "KeyBinding({}, {}, {}, {})".format(self.number, self.callback, self.key, self.modifier)
+
+class Keyfile():
+    """A parsed keyfile
+
+    Keeps every line as a list of tokens and the keyboard callback lines as
+    KeyBinding records. A keyfile parsed from its bytes also keeps the original
+    data and the byte offset of every line (for writing it back). Commented out
+    lines, lines which are not callbacks (SimDoNothing), empty lines and DirectX
+    button assigment lines (len == 7) are not bindings. The bindings are indexed by callback and by
+    (keycode, modifier), and the lines of required callbacks which are assigned
+    to a key are precomputed in required_lines."""
+
+    def __init__(self, lines, data=None, offsets=None):
+        self.data = data
+        self.offsets = offsets
+        self.lines = []
+        self.bindings = []
+        self.by_callback = {}
+        self.by_key = {}
+        self.assigned = set()
+        self.required_lines = []
+        for line in lines:
+            self.add_line(line)
+
+    @classmethod
+    def parse(cls, data):
+        """Parse the bytes of a keyfile."""
+        lines = []
+        offsets = []
+        offset = 0
+        for raw_line in data.splitlines(keepends=True):
+            offsets.append(offset)
+            offset += len(raw_line)
+            # latin-1 maps every byte, so the tokens never fail to decode
+            tokens = raw_line.decode("latin-1").split()
+            # keep the whitespace
+            lines.append(tokens if tokens else ["\n"])
+        return cls(lines, data, offsets)
+
+    def newline(self):
+        """Return the line ending used in the original data."""
+        if self.data and self.offsets and len(self.offsets) > 1:
+            return b"\r\n" if self.data[:self.offsets[1]].endswith(b"\r\n") else b"\n"
+        return b"\r\n" if self.data and self.data.endswith(b"\r\n") else b"\n"
+
+    def add_line(self, line):
+        number = len(self.lines)
+        self.lines.append(line)
+        if line[0].startswith("#") or line[0] == "SimDoNothing" or line[0] == "\n" or len(line) == 7 or len(line) < 5:
+            return None
+        # joins every element after the 8th into a string (UI description)
+        line[8:] = [" ".join(line[8:])]
+        # use all caps in the hex codes to avoid duplicate issues
+        line[3] = line[3].upper()
+        binding = KeyBinding(number, line)
+        self.bindings.append(binding)
+        self.by_callback.setdefault(binding.callback, []).append(binding)
+        self.by_key.setdefault((binding.key, binding.modifier), []).append(binding)
+        if binding.key != UNASSIGNED_KEY:
+            self.assigned.add(binding.callback)
+            if binding.callback in airframes.callback_set:
+                self.required_lines.append(binding)
+        return binding
+
+    def keys_in_use(self):
+        """Return a set-like view of the (keycode, modifier) tuples used in the keyfile."""
+        return self.by_key.keys()
+
+    def lines_for_callback(self, callback):
+        return self.by_callback.get(callback, [])
+
+    def analyze(self):
+        """Return the KeyfileAnalysis of the keyfile."""
+        return KeyfileAnalysis(
+            self.assigned,
+            [RequiredLine(line.callback, line.key, line.modifier) for line in self.required_lines],
+            self.keys_in_use())
+
+RequiredLine = collections.namedtuple("RequiredLine", ["callback", "key", "modifier"])
+
+class KeyfileAnalysis():
+    """What's needed from a processed keyfile
+
+    The assigned callbacks, the RequiredLines of the required callbacks assigned to
+    keys and the (keycode, modifier) tuples in use."""
+    __slots__ = ("assigned", "required_lines", "used_keys")
+
+    def __init__(self, assigned, required_lines, used_keys):
+        self.assigned = frozenset(assigned)
+        self.required_lines = list(required_lines)
+        self.used_keys = frozenset(used_keys)
+
+    def to_json(self):
+        return {
+            "assigned": sorted(self.assigned),
+            "required_lines": [list(line) for line in self.required_lines],
+            "used_keys": sorted(list(key) for key in self.used_keys),
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(
+            data["assigned"],
+            [RequiredLine(*line) for line in data["required_lines"]],
+            [tuple(key) for key in data["used_keys"]])
+
+def cache_directory():
+    """Return the directory for Falcon-BCC's cached data."""
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+        return os.path.join(base, "Falcon-BCC")
+    base = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(base, "falcon-bcc")
+
+def hash_file(path):
+    with open(path, "rb") as content:
+        return hashlib.sha256(content.read()).hexdigest()
+
+class KeyfileCache():
+    """On-disk cache of keyfile analyses
+
+    Entries are keyed by the keyfile path and validated by its size and
+    modification time. If only the modification time differs, the content hash
+    decides whether the entry is still valid. Entries made for a different list
+    of required callbacks (see AirframeProfiles) are never used. The least
+    recently used entries are evicted once there are more than `size` of them.
+    A missing or broken cache file is treated as an empty cache.
+    """
+    version = 1
+
+    def __init__(self, path, size=8):
+        self.path = path
+        self.size = size
+        self.entries = None
+
+    @property
+    def required(self):
+        return airframes.digest
+
+    def load(self):
+        if self.entries is not None:
+            return
+        self.entries = collections.OrderedDict()
+        try:
+            with open(self.path, "r") as cache_file:
+                data = json.load(cache_file)
+            if data.get("version") == self.version:
+                for entry in data["entries"]:
+                    self.entries[entry["path"]] = entry
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            self.entries.clear()
+
+    def save(self):
+        data = {"version": self.version, "entries": list(self.entries.values())}
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = "{}.tmp".format(self.path)
+            with open(temp_path, "w") as cache_file:
+                json.dump(data, cache_file)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            notify("Warning: couldn't write the keyfile cache: {}".format(e))
+
+    @staticmethod
+    def key(keyfile_path):
+        return os.path.normcase(os.path.abspath(keyfile_path))
+
+    def get(self, keyfile_path):
+        """Return the cached KeyfileAnalysis of a keyfile or None."""
+        self.load()
+        key = self.key(keyfile_path)
+        entry = self.entries.get(key)
+        if entry is None or entry.get("required") != self.required:
+            return None
+        changed = next(reversed(self.entries)) != key
+        try:
+            stat = os.stat(keyfile_path)
+            if stat.st_size != entry["size"]:
+                return None
+            if stat.st_mtime_ns != entry["mtime"]:
+                if hash_file(keyfile_path) != entry["sha256"]:
+                    return None
+                entry["mtime"] = stat.st_mtime_ns
+                changed = True
+            analysis = KeyfileAnalysis.from_json(entry["analysis"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if changed:
+            self.entries.move_to_end(key)
+            self.save()
+        return analysis
+
+    def put(self, keyfile_path, analysis):
+        """Cache the KeyfileAnalysis of a keyfile."""
+        self.load()
+        key = self.key(keyfile_path)
+        try:
+            stat = os.stat(keyfile_path)
+            sha256 = hash_file(keyfile_path)
+        except OSError:
+            return
+        self.entries.pop(key, None)
+        self.entries[key] = {
+            "path": key,
+            "required": self.required,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "sha256": sha256,
+            "analysis": analysis.to_json(),
+        }
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        self.save()
+
+keyfile_cache = KeyfileCache(os.path.join(cache_directory(), "keyfiles.json"))
+
+def modifier_class(modifier):
+    """Return the class of a modifier: "none", "single" or "combo" (several keys)."""
+    return ("none", "single", "combo")[min(len(MODIFIER_SCANCODES.get(modifier, ())), 2)]
+
+class KeyPacing():
+    """Calibrated delays between key edges, per modifier class
+
+    The delays are learned with --calibrate (see calibrate_pacing()) and stored
+    per machine, since they depend on how fast the sim processes the input.
+    Classes without a calibrated delay use the input engine's default."""
+    version = 1
+
+    def __init__(self, delays=None):
+        self.delays = dict(delays or {})
+
+    def delay(self, modifier, default):
+        return self.delays.get(modifier_class(modifier), default)
+
+    @classmethod
+    def load(cls, path, machine=None):
+        """Return the KeyPacing of a machine (this one by default) or None."""
+        try:
+            with open(path, "r") as pacing_file:
+                data = json.load(pacing_file)
+            if data.get("version") != cls.version:
+                return None
+            entry = data["machines"].get(machine or platform.node())
+            if entry is None:
+                return None
+            return cls({name: float(delay) for name, delay in entry["delays"].items()})
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return None
+
+    def save(self, path, machine=None):
+        data = {"version": self.version, "machines": {}}
+        try:
+            with open(path, "r") as pacing_file:
+                previous = json.load(pacing_file)
+            if previous.get("version") == self.version:
+                data["machines"].update(previous["machines"])
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            pass
+        data["machines"][machine or platform.node()] = {"delays": self.delays, "time": time.time()}
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = "{}.tmp".format(path)
+            with open(temp_path, "w") as pacing_file:
+                json.dump(data, pacing_file, indent=2)
+            os.replace(temp_path, path)
+        except OSError as e:
+            notify("Warning: couldn't write the key pacing: {}".format(e))
+
+PACING_PATH = os.path.join(cache_directory(), "pacing.json")
+
+class AirframeProfile():
+    """The callbacks of the switches an airframe has
+
+    The profile is picked by matching the AcName and CockpitFile strings of the
+    string area against wildcard patterns (case insensitive). Its callbacks are
+    kept in their order and compiled into a frozen set."""
+    __slots__ = ("name", "ac_names", "cockpit_files", "callbacks", "callback_set")
+
+    def __init__(self, name, callbacks, ac_names=(), cockpit_files=()):
+        self.name = name
+        self.callbacks = tuple(dict.fromkeys(callbacks))
+        self.callback_set = frozenset(self.callbacks)
+        self.ac_names = tuple(pattern.lower() for pattern in ac_names)
+        self.cockpit_files = tuple(pattern.lower() for pattern in cockpit_files)
+
+    def __repr__(self):
+        return "AirframeProfile({}, {} callbacks)".format(self.name, len(self.callbacks))
+
+    def matches(self, ac_name, cockpit_file):
+        ac_name = ac_name.lower()
+        cockpit_file = cockpit_file.lower()
+        return (any(fnmatch.fnmatchcase(ac_name, pattern) for pattern in self.ac_names) or
+            any(fnmatch.fnmatchcase(cockpit_file, pattern) for pattern in self.cockpit_files))
+
+    @classmethod
+    def load(cls, path, base):
+        """Load a profile from a JSON file
+
+        The file has a "name", the "match" patterns by string ({"AcName": [...],
+        "CockpitFile": [...]}) and either its "callbacks" or the callbacks to
+        "add" to and "remove" from the base profile. Raises ValueError if the file
+        isn't a valid profile."""
+        with open(path, "r") as profile_file:
+            data = json.load(profile_file)
+        try:
+            match = data.get("match", {})
+            callbacks = list(data.get("callbacks", base.callbacks)) + list(data.get("add", []))
+            remove = set(data.get("remove", []))
+            names = list(callbacks) + list(remove)
+            if not all(isinstance(callback, str) and callback.startswith("Sim") for callback in names):
+                raise ValueError("callbacks have to be strings starting with Sim")
+            profile = cls(
+                str(data.get("name", os.path.splitext(os.path.basename(path))[0])),
+                [callback for callback in callbacks if callback not in remove],
+                list(match.get("AcName", [])),
+                list(match.get("CockpitFile", [])))
+        except (AttributeError, TypeError) as e:
+            raise ValueError("not a profile: {}".format(e))
+        if not profile.ac_names and not profile.cockpit_files:
+            raise ValueError("no AcName or CockpitFile patterns to match")
+        return profile
+
+DEFAULT_AIRFRAME = AirframeProfile("F-16", REQUIRED_CALLBACKS)
+AIRFRAMES_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "airframes")
+
+class AirframeProfiles():
+    """The airframe profiles which are in use
+
+    The first profile matching the current jet is used for the randomizations,
+    the default one (the F-16) if none does. The required callbacks are those of
+    all the profiles, so a keyfile is padded for every jet which can be flown
+    with it; digest identifies them in the keyfile cache. Selected profiles are
+    cached by their AcName and CockpitFile."""
+
+    def __init__(self, profiles=(), default=DEFAULT_AIRFRAME):
+        self.profiles = list(profiles)
+        self.default = default
+        self.callbacks = tuple(dict.fromkeys(callback
+            for profile in [default] + self.profiles for callback in profile.callbacks))
+        self.callback_set = frozenset(self.callbacks)
+        self.digest = hashlib.sha256("\n".join(self.callbacks).encode("utf-8")).hexdigest()
+        self.selected = {}
+
+    @classmethod
+    def load(cls, directory=AIRFRAMES_DIRECTORY, default=DEFAULT_AIRFRAME):
+        """Load the profiles of the .json files in a directory, in name order
+
+        A missing directory means no profiles; broken profiles are skipped with
+        a warning."""
+        profiles = []
+        for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+            try:
+                profiles.append(AirframeProfile.load(path, default))
+            except (OSError, ValueError) as e:
+                notify("Warning: skipping the airframe profile {}: {}".format(path, e))
+        if profiles:
+            notify("Airframe profiles: {}".format(", ".join(profile.name for profile in profiles)))
+        return cls(profiles, default)
+
+    def select(self, ac_name, cockpit_file):
+        """Return the profile of the jet with the given AcName and CockpitFile."""
+        key = (ac_name, cockpit_file)
+        profile = self.selected.get(key)
+        if profile is None:
+            profile = next((profile for profile in self.profiles if profile.matches(ac_name, cockpit_file)),
+                self.default)
+            self.selected[key] = profile
+        return profile
+
+    def validate(self, keyfile_content):
+        """Check the loaded profiles against a keyfile
+
+        Returns {profile name: callbacks} of the callbacks which don't have any
+        line in the keyfile, e.g. misspelt ones or those of another BMS version.
+        The default profile is trusted; keyfiles are padded for all of it."""
+        unknown = {}
+        for profile in self.profiles:
+            callbacks = [callback for callback in profile.callbacks
+                if callback not in self.default.callback_set and not keyfile_content.lines_for_callback(callback)]
+            if callbacks:
+                unknown[profile.name] = callbacks
+        return unknown
+
+airframes = AirframeProfiles()
+
+def use_airframes(profiles):
+    global airframes
+    airframes = profiles
+
+def current_airframe():
+    """Return the AirframeProfile of the jet in the sim (the default one if unknown)."""
+    strings = read_shared_memory_strings()
+    if strings is None:
+        return airframes.default
+    return airframes.select(strings.AcName, strings.CockpitFile)
+
+def unknown_callbacks(keyfile_content):
+    """Warn about the profile callbacks missing from a keyfile and return them as a set."""
+    unknown = airframes.validate(keyfile_content)
+    for name, callbacks in unknown.items():
+        notify("Warning: airframe profile {}: not in the keyfile, skipped: {}".format(name, ", ".join(callbacks)))
+    return {callback for callbacks in unknown.values() for callback in callbacks}
+
 def get_keyfile_content(keyfile_path):
     """Get the keyfile content from the keyfile path.
 
-    Returns a list of lists with each element holding one line of the keyfile."""
-    fajl = open(keyfile_path, "r")
-    lines = []
-    for line in fajl:
-        # keep the whitespace
-        if line == "\n":
-            lines.append([line])
-        else:
-            lines.append(line.split())
-    return lines
+    Returns a Keyfile with each line of the keyfile split into tokens."""
+    with open(keyfile_path, "rb") as fajl:
+        return Keyfile.parse(fajl.read())
 
 def get_filtered_keyfile(keyfile_content):
     """Filters the keyfile content.
 
-    Removes commented out lines, lines which are not callbacks (SimDoNothing), empty
-    lines and DirectX button assigment lines (len == 7) and joins the UI description
-    into a single string. Returns a list of lists with each element holding one line
-    of the keyfile."""
-    filtered_keyfile = []
-    for line in keyfile_content:
-        if line[0].startswith("#") or line[0] == "SimDoNothing" or line[0] == "\n" or len(line) == 7:
-            continue
-        else:
-            # joins every element after the 8th into a string (UI description)
-            line[8:] = [" ".join(line[8:])]
-            # use all caps in the hex codes to avoid duplicate issues
-            line[3] = line[3].upper()
-            filtered_keyfile.append(line)
-    return filtered_keyfile
+    Returns the KeyBinding records of the keyboard callback lines; see Keyfile."""
+    return keyfile_content.bindings
 
 def get_assigned_callbacks(keyfile_content):
     """Get the assigned callbacks from the keyfile content.
 
-    Returns a list with only the callbacks which are assigned to a key."""
-    assigned_callbacks = []
-    for line in keyfile_content:
-        if line[3].upper() != "0XFFFFFFFF":
-            assigned_callbacks.append(line[0])
-    return assigned_callbacks
+    Returns a set with only the callbacks which are assigned to a key."""
+    return keyfile_content.assigned
 
-def get_unassigned_callbacks(assigned_callbacks):
+def get_unassigned_callbacks(assigned_callbacks, skip=()):
     """Get callbacks which aren't assigned yet
 
     Compares the callbacks which have been assigned to the required
-    callbacks and returns a list with callbacks that aren't assigned."""
-    unassigned_callbacks = []
-    for callback in REQUIRED_CALLBACKS:
-        if callback not in assigned_callbacks:
-            unassigned_callbacks.append(callback)
-    return unassigned_callbacks
-
-def get_used_keys(keyfile_filtered):
+    callbacks and returns a list with callbacks that aren't assigned. Callbacks
+    in skip (see AirframeProfiles.validate()) are left out."""
+    return [callback for callback in airframes.callbacks if callback not in assigned_callbacks and callback not in skip]
+
+def get_used_keys(keyfile_content):
     """Get assigned keyboard keys
 
     The assigned keys are the 3rd and 4th element of a line in a keyfile.
     The first is the keycode and the second one the modifier.
-    Returns a list of tuples containing the keycode and modifier."""
-    used_keys = []
-    for line in keyfile_filtered:
-        used_keys.append((line[3], line[4]))
-    return used_keys
+    Returns a set of tuples containing the keycode and modifier."""
+    return keyfile_content.keys_in_use()
+
+# Alt+Shift ("5") is left out; the default language switcher shortcut (makes the pop appear)
+ASSIGNABLE_MODIFIERS = ["0", "1", "2", "3", "4", "6", "7"]
+
+def modifier_cost(modifier):
+    """Return the cost of injecting a key with a modifier
+
+    The cost is the number of delays and the number of key edges of the key press;
+    see InputEngine.compile_key()."""
+    modifiers = MODIFIER_SCANCODES[modifier]
+    return (2 if modifiers else 1, 2 * (len(modifiers) + 1))
+
+class KeySpace():
+    """Bitset of the keyboard keys and modifiers which are still free
+
+    Every (keycode, modifier) combination is one bit. The modifiers are ordered by
+    their injection cost and the bits numbered modifier by modifier, so the lowest
+    free bit is always the cheapest free key. Keycodes are compared by value, so
+    "0X2" and "0x02" are the same key."""
+
+    def __init__(self, used_keys=(), scancodes=KEYBOARD_SCANCODES, modifiers=ASSIGNABLE_MODIFIERS):
+        self.scancodes = list(scancodes)
+        self.modifiers = sorted(modifiers, key=modifier_cost)
+        self.scancode_index = {int(code, 16): index for index, code in enumerate(self.scancodes)}
+        self.modifier_index = {modifier: index for index, modifier in enumerate(self.modifiers)}
+        self.size = len(self.scancodes) * len(self.modifiers)
+        self.free = (1 << self.size) - 1
+        for key, modifier in used_keys:
+            self.reserve(key, modifier)
+
+    def bit(self, key, modifier):
+        """Return the bit index of a key or None if it's not part of the key space."""
+        try:
+            scancode = self.scancode_index.get(int(key, 16))
+        except ValueError:
+            return None
+        modifier = self.modifier_index.get(modifier)
+        if scancode is None or modifier is None:
+            return None
+        return modifier * len(self.scancodes) + scancode
+
+    def reserve(self, key, modifier):
+        """Mark a key as used; returns False if it wasn't free."""
+        bit = self.bit(key, modifier)
+        if bit is None or not self.free >> bit & 1:
+            return False
+        self.free &= ~(1 << bit)
+        return True
+
+    def release(self, key, modifier):
+        bit = self.bit(key, modifier)
+        if bit is not None:
+            self.free |= 1 << bit
+
+    def allocate(self):
+        """Reserve and return the cheapest free (keycode, modifier) or None."""
+        if not self.free:
+            return None
+        lowest = self.free & -self.free
+        self.free ^= lowest
+        bit = lowest.bit_length() - 1
+        modifier, scancode = divmod(bit, len(self.scancodes))
+        return self.scancodes[scancode], self.modifiers[modifier]
+
+    def remaining(self):
+        return bin(self.free).count("1")
+
+def expected_presses(callback):
+    """Return how often a callback is pressed in a randomization on average."""
+    control = CALLBACK_CONTROLS.get(callback)
+    if control is None or control.positions is None:
+        return 3.5
+    if control.direct:
+        return 1 / len(control.callbacks)
+    return (control.positions - 1) / 2
 
 def get_unused_keys(used_keys):
     """Get unused keyboard keys
 
     Checks all the possible keyboard key combinations with the modifiers
     and removes those already in use in the keyfile.
-    Returns a list of tuples containing the unused keycode and modifier."""
-    # Remove Alt+Shift ("5") the default language switcher shortcut (makes the pop appear)
-    modifiers = ["0", "1", "2", "3", "4", "6", "7"]
-
-    all_possible_keys = itertools.product(KEYBOARD_SCANCODES, modifiers)
-    unused_keys_set = set(all_possible_keys) - set(used_keys)
-    unused_keys_list = sorted(list(unused_keys_set), key=lambda x: x[1])
-    if len(unused_keys_list) < len(REQUIRED_CALLBACKS):
+    Returns a KeySpace holding the unused keys."""
+    unused_keys = KeySpace(used_keys)
+    if unused_keys.remaining() < len(airframes.callbacks):
         notify("Warning: not enough unused keys to assign all the required callbacks")
         sys.exit(1)
-    return unused_keys_list
+    return unused_keys
 
 def assign_unused_callbacks(unassigned_callbacks, unused_keys):
     """Assign unused callbacks to unused keys
 
-    Goes through every unassigned callback and assigns it to an unused key.
+    Goes through every unassigned callback and assigns it to an unused key. The
+    callbacks pressed most often get the cheapest keys.
     Returns a list of properly formatted Falcon BMS keyfile lines."""
+    keys = {}
+    for cb in sorted(unassigned_callbacks, key=expected_presses, reverse=True):
+        keys[cb] = unused_keys.allocate()
     new_assigned_lines = []
     # TODO: modify to keep the sound ID (2nd part of the line, currently always -1)
     callback_template = '{} -1 0 {} {} 0 0 1 "GeneratedByFalcon-BCC"'
     for cb in unassigned_callbacks:
-        key, mod = unused_keys.pop(0)
+        key, mod = keys[cb]
         new_callback = callback_template.format(cb, key, mod)
         new_callback_line = new_callback.split()
         new_assigned_lines.append(new_callback_line)
@@ -653,28 +2112,146 @@ def backup_keyfile(original_keyfile_path):
     shutil.copy2(original_keyfile_path, backup_keyfile_path)
     notify("Original Keyfile backed up to: {}".format(backup_keyfile_path))
 
-def write_new_keyfile(original_keyfile_content, new_callbacks_content, keyfile_path):
+def write_new_keyfile(original_keyfile_content, new_callbacks_content, keyfile_path, output_path=None):
     """Create the new keyfile.
 
     It comments out the original callback line for the new callbacks we added to keep
-    the file integrity. It also keeps newlines as per the original file."""
-    single_new_callbacks = [x[0] for x in new_callbacks_content]
-
-    with open(keyfile_path, "w") as keyfile:
-        for line in original_keyfile_content:
-            if line[0] in single_new_callbacks:
-                # comments out the assigned callbacks; we will add them below
-                keyfile.write("#{}\n".format(" ".join(line)))
-            elif line[0] == "\n":
-                keyfile.write("\n")
+    the file integrity and appends the new callbacks. Every other byte of the original
+    file is kept as it was. The new keyfile is written to a temporary file first and
+    then moved over the original (or to output_path, if passed), so a crash can't
+    leave a half written keyfile. Nothing is written if there are no new callbacks."""
+    if not new_callbacks_content:
+        return
+    single_new_callbacks = {x[0] for x in new_callbacks_content}
+    data = original_keyfile_content.data
+    offsets = original_keyfile_content.offsets
+
+    parts = []
+    previous = 0
+    for number, line in enumerate(original_keyfile_content.lines):
+        if line[0] in single_new_callbacks:
+            # comments out the assigned callbacks; we will add them below
+            parts.append(data[previous:offsets[number]])
+            parts.append(b"#")
+            previous = offsets[number]
+    parts.append(data[previous:])
+    newline = original_keyfile_content.newline()
+    if data and not data.endswith(b"\n"):
+        parts.append(newline)
+    parts.append(newline + b"### Generated by Falcon-BCC ###" + newline)
+    for line in new_callbacks_content:
+        parts.append(" ".join(line).encode("latin-1") + newline)
+
+    output_path = output_path or keyfile_path
+    directory = os.path.dirname(os.path.abspath(output_path))
+    descriptor, temp_path = tempfile.mkstemp(prefix=".falcon-bcc-", suffix=".key", dir=directory)
+    try:
+        with os.fdopen(descriptor, "wb") as keyfile:
+            keyfile.write(b"".join(parts))
+            keyfile.flush()
+            os.fsync(keyfile.fileno())
+        shutil.copymode(keyfile_path, temp_path)
+        os.replace(temp_path, output_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    notify("All required callbacks added to Keyfile: {}".format(output_path))
+
+def find_keyfiles(pattern):
+    """Return the .key files in a directory or matching a glob pattern."""
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "*.key")
+    return sorted(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+
+def keyfile_conflicts(keyfile_content):
+    """Return the keys bound to more than one callback as {"keycode modifier": [callbacks]}."""
+    conflicts = {}
+    for (key, modifier), bindings in keyfile_content.by_key.items():
+        callbacks = sorted({binding.callback for binding in bindings})
+        if key != UNASSIGNED_KEY and len(callbacks) > 1:
+            conflicts["{} {}".format(key, modifier)] = callbacks
+    return conflicts
+
+def audit_keyfile(keyfile_path, output_path=None):
+    """Audit a keyfile and write a patched copy of it
+
+    Runs the same pipeline as process_keyfile() on a keyfile, but writes the result
+    to output_path (if passed) instead of the keyfile itself; a keyfile which
+    doesn't need any changes is copied as it is. Returns a report with the required
+    callbacks which were missing, the conflicting keys, the number of free
+    keys left after the patching and the callbacks of airframe profiles which
+    aren't in the keyfile (if any)."""
+    report = {"path": keyfile_path, "output": None}
+    try:
+        keyfile_content = get_keyfile_content(keyfile_path)
+        unknown = airframes.validate(keyfile_content)
+        skip = {callback for callbacks in unknown.values() for callback in callbacks}
+        unassigned_callbacks = get_unassigned_callbacks(get_assigned_callbacks(keyfile_content), skip)
+        unused_keys = KeySpace(get_used_keys(keyfile_content))
+        report["missing"] = unassigned_callbacks
+        if unknown:
+            report["unknown"] = unknown
+        report["conflicts"] = keyfile_conflicts(keyfile_content)
+        if unused_keys.remaining() < len(unassigned_callbacks):
+            report["error"] = "not enough unused keys to assign all the required callbacks"
+            return report
+        new_callbacks_content = assign_unused_callbacks(unassigned_callbacks, unused_keys)
+        report["free"] = unused_keys.remaining()
+        if output_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+            if new_callbacks_content:
+                write_new_keyfile(keyfile_content, new_callbacks_content, keyfile_path, output_path)
             else:
-                keyfile.write("{}\n".format(" ".join(line)))
+                shutil.copy2(keyfile_path, output_path)
+            report["output"] = output_path
+    except OSError as e:
+        report["error"] = str(e)
+    return report
+
+def audit_keyfiles(paths, output_directory=None, jobs=None):
+    """Audit keyfiles in parallel processes; see audit_keyfile()
 
-        keyfile.write("\n### Generated by Falcon-BCC ###\n")
-        for line in new_callbacks_content:
-            joined_line = " ".join(line)
-            keyfile.write("{}\n".format(joined_line))
-    notify("All required callbacks added to Keyfile: {}".format(keyfile_path))
+    The patched copies keep their paths relative to the common directory of the
+    keyfiles. The workers use the airframe profiles of this process. Returns the
+    reports in the order of the paths."""
+    if not paths:
+        return []
+    base = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths])
+    outputs = [None] * len(paths)
+    if output_directory is not None:
+        outputs = [os.path.join(output_directory, os.path.relpath(os.path.abspath(path), base)) for path in paths]
+    jobs = jobs or os.cpu_count() or 1
+    chunksize = max(1, len(paths) // (jobs * 4))
+    with concurrent.futures.ProcessPoolExecutor(jobs, initializer=use_airframes,
+            initargs=(airframes,)) as executor:
+        return list(executor.map(audit_keyfile, paths, outputs, chunksize=chunksize))
+
+def batch(pattern, output_directory, report_path=None, jobs=None):
+    """Audit and patch a directory or glob of keyfiles without the sim
+
+    Writes the patched copies into output_directory and a JSON report of all of
+    them to report_path (report.json in output_directory by default). Returns
+    the number of keyfiles which couldn't be patched."""
+    paths = find_keyfiles(pattern)
+    if not paths:
+        notify("No keyfiles found: {}".format(pattern))
+        return 0
+    start = time.perf_counter()
+    reports = audit_keyfiles(paths, output_directory, jobs)
+    elapsed = time.perf_counter() - start
+    report_path = report_path or os.path.join(output_directory, "report.json")
+    os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+    with open(report_path, "w") as report_file:
+        json.dump({"keyfiles": reports, "seconds": elapsed}, report_file, indent=2)
+    failed = [report for report in reports if "error" in report]
+    for report in failed:
+        notify("Warning: {}: {}".format(report["path"], report["error"]))
+    notify("Audited {} keyfile(s) in {:.2f}s, {} patched, {} with conflicts; report: {}".format(
+        len(reports), elapsed,
+        sum(1 for report in reports if report.get("missing") and "error" not in report),
+        sum(1 for report in reports if report.get("conflicts")),
+        report_path))
+    return len(failed)
 
 def falcon_running():
     """Return True if Falcon BMS is running
@@ -685,85 +2262,1058 @@ def falcon_running():
     if strings and strings.KeyFile:
         return True
 
+FILE_MAP_READ = 0x0004
+
+class MappingProbe():
+    """Checks whether a named Windows file mapping exists
+
+    Only opens and closes a handle to the mapping, without mapping it."""
+
+    def __init__(self, name):
+        self.name = name
+        kernel32 = ctypes.windll.kernel32
+        self.open = kernel32.OpenFileMappingW
+        self.open.argtypes = (ctypes.c_ulong, ctypes.c_int, ctypes.c_wchar_p)
+        self.open.restype = ctypes.c_void_p
+        self.close = kernel32.CloseHandle
+        self.close.argtypes = (ctypes.c_void_p,)
+
+    def __call__(self):
+        handle = self.open(FILE_MAP_READ, False, self.name)
+        if not handle:
+            return False
+        self.close(handle)
+        return True
+
+class FileProbe():
+    """Checks whether a file-backed shared memory area exists."""
+
+    def __init__(self, directory, name):
+        self.path = os.path.join(directory, name)
+
+    def __call__(self):
+        return os.path.exists(self.path)
+
+class SimDetector():
+    """Waits for Falcon BMS to start
+
+    Instead of reading the string area, a cheap probe checks whether it exists:
+    the named mapping on Windows or, with file-backed shared memory, its file. The
+    probe is retried with an exponential backoff from `initial` up to `cap`
+    seconds; once it succeeds, falcon_running() confirms that the sim is ready.
+    """
+
+    def __init__(self, probe, initial=0.05, cap=0.8):
+        self.probe = probe
+        self.initial = initial
+        self.cap = cap
+
+    @classmethod
+    def create(cls, directory=None):
+        """Create a detector for the Windows mappings or for the areas in directory."""
+        if directory is None:
+            return cls(MappingProbe(Strings.name))
+        return cls(FileProbe(directory, Strings.name))
+
+    async def wait(self):
+        delay = self.initial
+        while not (self.probe() and falcon_running()):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.cap)
+
 def process_keyfile():
+    """Process the keyfile and record how long it took; see analyze_keyfile()."""
+    with instrumentation.timer("keyfile_processing"):
+        return analyze_keyfile()
+
+def analyze_keyfile():
     """Process the keyfile
 
     The routine for the keyfile part: gets its path and reads the keyfile, filters
     only the useful lines out, gets all the assigned and unassigned callbacks and
-    finally writes it to our keyfile if necessary.
-    Returns a string with the path of the used keyfile."""
+    finally writes it to our keyfile if necessary. The airframe profiles are
+    validated against the keyfile first; see unknown_callbacks(). Keyfiles which
+    were already processed and didn't change since are taken from the keyfile
+    cache.
+    Returns a string with the path of the used keyfile and its KeyfileAnalysis."""
     keyfile_path = get_keyfile_path()
+    analysis = keyfile_cache.get(keyfile_path)
+    if analysis is not None:
+        notify("Keyfile verified (cached): all required callbacks assigned.")
+        return keyfile_path, analysis
     keyfile_content = get_keyfile_content(keyfile_path)
-    filtered_keyfile = get_filtered_keyfile(keyfile_content)
-    assigned_callbacks = get_assigned_callbacks(filtered_keyfile)
-    unassigned_callbacks = get_unassigned_callbacks(assigned_callbacks)
+    assigned_callbacks = get_assigned_callbacks(keyfile_content)
+    unassigned_callbacks = get_unassigned_callbacks(assigned_callbacks, unknown_callbacks(keyfile_content))
     if unassigned_callbacks:
-        used_keys = get_used_keys(filtered_keyfile)
+        used_keys = get_used_keys(keyfile_content)
         unused_keys = get_unused_keys(used_keys)
         new_callbacks_content = assign_unused_callbacks(unassigned_callbacks, unused_keys)
         backup_keyfile(keyfile_path)
         write_new_keyfile(keyfile_content, new_callbacks_content, keyfile_path)
+        keyfile_content = get_keyfile_content(keyfile_path)
     else:
         notify("Keyfile verified: all required callbacks assigned.")
-    return keyfile_path, keyfile_content
+    analysis = keyfile_content.analyze()
+    keyfile_cache.put(keyfile_path, analysis)
+    return keyfile_path, analysis
+
+class Control():
+    """A physical switch or knob in the cockpit
+
+    A control either has a callback for each of its positions (direct set, e.g. the
+    INS knob), or a single callback which steps through its positions and wraps
+    around (a toggle has two). A cycling control with an unknown number of
+    positions is pressed a random number of times, like every callback used to be.
+    """
+    __slots__ = ("name", "callbacks", "positions")
+
+    def __init__(self, name, callbacks, positions=None):
+        self.name = name
+        self.callbacks = tuple(callbacks)
+        if positions is None and len(self.callbacks) > 1:
+            positions = len(self.callbacks)
+        self.positions = positions
+
+    @property
+    def direct(self):
+        return len(self.callbacks) > 1
+
+def toggles(*callbacks):
+    return [Control(callback, [callback], 2) for callback in callbacks]
+
+SWITCH_CATALOG = [
+    Control("PROBE HEAT", ["SimProbeHeatOn", "SimProbeHeatOff", "SimProbeHeatTest"]),
+    *toggles("SimDigitalBUP", "SimAltFlaps", "SimManualFlyup", "SimLEFLockSwitch", "SimTrimAPDisc"),
+    *toggles("SimToggleMasterFuel", "SimFuelDoorToggle"),
+    Control("ENGINE FEED", ["SimFuelPumpOff", "SimFuelPumpNorm", "SimFuelPumpAft", "SimFuelPumpFwd"]),
+    Control("IFF MASTER", ["SimIFFMasterOff", "SimIFFMasterStby", "SimIFFMasterLow", "SimIFFMasterNorm", "SimIFFMasterEmerg"]),
+    *toggles("SimToggleAuxComMaster", "SimIFFMode4MonitorToggle", "SimToggleAuxComAATR"),
+    Control("SimIFFMode4ReplyCycle", ["SimIFFMode4ReplyCycle"], 3),
+    Control("SimIFFEnableCycle", ["SimIFFEnableCycle"], 3),
+    *toggles("SimExtlAntiColl", "SimExtlSteady", "SimExtlPower"),
+    Control("ANTI-COLLISION MODE", ["SimAntiColModeOff", "SimAntiColMode1", "SimAntiColMode2", "SimAntiColMode3",
+        "SimAntiColMode4", "SimAntiColModeA", "SimAntiColModeB", "SimAntiColModeC"]),
+    Control("SimWingLightCycle", ["SimWingLightCycle"], 3),
+    Control("SimFuselageLightCycle", ["SimFuselageLightCycle"], 3),
+    Control("SimEpuToggle", ["SimEpuToggle"], 3),
+    Control("SimAVTRSwitch", ["SimAVTRSwitch"], 3),
+    *toggles("SimEcmPower"),
+    Control("ECM XMIT", ["SimXMit1", "SimXMit2", "SimXMit3"]),
+    *toggles("SimEngCont", "SimAud1Com1", "SimAud1Com2", "SimMPOToggle", "SimSeatArm"),
+    Control("UHF FUNCTION", ["SimBupUhfOff", "SimBupUhfMain", "SimBupUhfBoth"]),
+    Control("UHF MODE", ["SimBupUhfManual", "SimBupUhfPreset", "SimBupUhfGuard"]),
+    *toggles("SimEWSRWRPower", "SimEWSJammerPower", "SimEWSMwsPower", "SimEWSO1Power", "SimEWSO2Power",
+        "SimEWSChaffPower", "SimEWSFlarePower", "SimEWSDispPower", "SimEwsJett"),
+    Control("EWS PROGRAM", ["SimEWSProgOne", "SimEWSProgTwo", "SimEWSProgThree", "SimEWSProgFour"]),
+    Control("EWS MODE", ["SimEWSModeOff", "SimEWSModeStby", "SimEWSModeMan", "SimEWSModeSemi", "SimEWSModeAuto", "SimEWSModeByp"]),
+    *toggles("SimGndJettEnable", "SimBrakeChannelToggle", "SimCATSwitch", "SimLaserArmToggle", "SimDriftCO"),
+    Control("SimParkingBrakeCycle", ["SimParkingBrakeCycle"], 3),
+    Control("SimLandingLightCycle", ["SimLandingLightCycle"], 3),
+    Control("SimRFSwitch", ["SimRFSwitch"], 3),
+    Control("SimStepMasterArm", ["SimStepMasterArm"], 3),
+    Control("SimLeftAPSwitch", ["SimLeftAPSwitch"], 3),
+    Control("SimRightAPSwitch", ["SimRightAPSwitch"], 3),
+    Control("SimStepHSIMode", ["SimStepHSIMode"], 4),
+    Control("FUEL QTY SEL", ["SimFuelSwitchTest", "SimFuelSwitchNorm", "SimFuelSwitchResv", "SimFuelSwitchWingInt",
+        "SimFuelSwitchWingExt", "SimFuelSwitchCenterExt"]),
+    *toggles("SimExtFuelTrans", "SimLeftHptPower", "SimRightHptPower", "SimFCRPower"),
+    Control("RALT", ["SimRALTON", "SimRALTSTDBY", "SimRALTOFF"]),
+    Control("SimHUDScales", ["SimHUDScales"], 3),
+    Control("SimScalesVVVAH", ["SimScalesVVVAH"], 3),
+    Control("SimHUDFPM", ["SimHUDFPM"], 3),
+    Control("SimHUDDED", ["SimHUDDED"], 3),
+    Control("SimReticleSwitch", ["SimReticleSwitch"], 3),
+    Control("SimHUDVelocity", ["SimHUDVelocity"], 3),
+    Control("SimHUDRadar", ["SimHUDRadar"], 3),
+    Control("SimHUDBrightness", ["SimHUDBrightness"], 3),
+    Control("SimInstrumentLight", ["SimInstrumentLight"], 3),
+    Control("AIR SOURCE", ["SimAirSourceOff", "SimAirSourceNorm", "SimAirSourceDump", "SimAirSourceRam"]),
+    *toggles("SimInhibitVMS"),
+    Control("SimAntiIceCycle", ["SimAntiIceCycle"], 3),
+    Control("SimAntennaSelectCycle", ["SimAntennaSelectCycle"], 3),
+    Control("INS", ["SimINSOff", "SimINSNorm", "SimINSNav", "SimINSInFlt"]),
+    *toggles("SimFCCPower", "SimSMSPower", "SimMFDPower", "SimUFCPower", "SimGPSPower", "SimDLPower", "SimMAPPower"),
+    Control("MIDS LVT", ["SimMIDSLVTOff", "SimMIDSLVTOn"]),
+]
+CALLBACK_CONTROLS = {callback: control for control in SWITCH_CATALOG for callback in control.callbacks}
+
+# the cockpit panels in the order they're reached during a cold start, with the
+# names of their controls; a randomization is streamed panel by panel
+PANELS = [
+    ("ENGINE & FUEL", ["SimToggleMasterFuel", "ENGINE FEED", "SimFuelDoorToggle", "SimExtFuelTrans", "FUEL QTY SEL",
+        "SimEpuToggle", "SimEngCont", "AIR SOURCE", "SimAntiIceCycle"]),
+    ("INTERIOR LIGHTS", ["SimInstrumentLight", "SimInteriorLight", "SimDedBrightness"]),
+    ("AVIONICS POWER", ["SimFCCPower", "SimSMSPower", "SimMFDPower", "SimUFCPower", "SimGPSPower", "SimDLPower",
+        "SimMAPPower", "MIDS LVT", "INS"]),
+    ("SENSOR POWER", ["SimLeftHptPower", "SimRightHptPower", "SimFCRPower", "RALT"]),
+    ("AUDIO & UHF", ["SimAud1Com1", "SimAud1Com2", "UHF FUNCTION", "UHF MODE", "SimInhibitVMS"]),
+    ("IFF", ["IFF MASTER", "SimIFFMode4ReplyCycle", "SimIFFEnableCycle", "SimIFFMode4MonitorToggle",
+        "SimToggleAuxComMaster", "SimToggleAuxComAATR", "SimAntennaSelectCycle"]),
+    ("EWS / CMDS", ["SimEcmPower", "ECM XMIT", "SimEWSRWRPower", "SimEWSJammerPower", "SimEWSMwsPower",
+        "SimEWSO1Power", "SimEWSO2Power", "SimEWSChaffPower", "SimEWSFlarePower", "SimEWSDispPower", "SimEwsJett",
+        "EWS PROGRAM", "EWS MODE"]),
+    ("HUD", ["SimHUDScales", "SimScalesVVVAH", "SimHUDFPM", "SimHUDDED", "SimReticleSwitch", "SimHUDVelocity",
+        "SimHUDRadar", "SimHUDBrightness", "SimDriftCO"]),
+    ("FLIGHT CONTROLS", ["SimDigitalBUP", "SimAltFlaps", "SimManualFlyup", "SimLEFLockSwitch", "SimTrimAPDisc",
+        "SimMPOToggle", "PROBE HEAT", "SimBrakeChannelToggle", "SimParkingBrakeCycle", "SimLeftAPSwitch",
+        "SimRightAPSwitch"]),
+    ("EXTERIOR LIGHTS", ["SimExtlPower", "SimExtlAntiColl", "SimExtlSteady", "ANTI-COLLISION MODE", "SimWingLightCycle",
+        "SimFuselageLightCycle", "SimLandingLightCycle", "SimStepAARLightsUp", "SimStepAARLightsDown"]),
+    ("ARMAMENT", ["SimStepMasterArm", "SimLaserArmToggle", "SimGndJettEnable", "SimCATSwitch", "SimRFSwitch",
+        "SimAVTRSwitch"]),
+    ("MISC", ["SimSeatArm", "SimStepHSIMode"]),
+]
+# panel of the controls which aren't on any of the PANELS
+OTHER_PANEL = "OTHER"
+CONTROL_PANELS = {control: panel for panel, controls in PANELS for control in controls}
+
+PlannedPress = collections.namedtuple("PlannedPress", ["control", "callback", "key", "modifier"])
+
+class RandomizationPlan():
+    """The key presses of one randomization
+
+    Besides the presses, it keeps the target of every control: the position index
+    for direct set controls (positions) and the number of steps for cycling ones
+    (steps), since their absolute position depends on where they started. The
+    line used for each control is kept in lines."""
+    __slots__ = ("presses", "positions", "steps", "lines")
+
+    def __init__(self):
+        self.presses = []
+        self.positions = {}
+        self.steps = {}
+        self.lines = {}
+
+def plan_randomization(analysis, rng=random, profile=None):
+    """Plan the key presses which put every control into a random position
+
+    A random target position is picked for each control and reached with as few
+    presses as possible: a single press of a direct set callback, or 0 to n-1
+    presses of a cycling one. Callbacks of required lines which aren't in the
+    catalog are pressed 1 to 6 times. The order of the controls is shuffled.
+    If an AirframeProfile is passed, only its callbacks are used, so no keys are
+    sent for switches the jet doesn't have.
+    Returns a RandomizationPlan."""
+    callbacks = None if profile is None else profile.callback_set
+    lines = {}
+    for line in analysis.required_lines:
+        if callbacks is None or line.callback in callbacks:
+            lines.setdefault(line.callback, line)
+    controls = []
+    seen = set()
+    for callback in lines:
+        control = CALLBACK_CONTROLS.get(callback)
+        if control is None:
+            control = Control(callback, [callback])
+        if control.name not in seen:
+            seen.add(control.name)
+            controls.append(control)
+    rng.shuffle(controls)
+
+    plan = RandomizationPlan()
+    for control in controls:
+        bound = [callback for callback in control.callbacks if callback in lines]
+        if control.direct:
+            callback = rng.choice(bound)
+            plan.positions[control.name] = control.callbacks.index(callback)
+            presses = 1
+        elif control.positions is None:
+            callback = bound[0]
+            presses = rng.randint(1, 6)
+        else:
+            callback = bound[0]
+            presses = plan.steps[control.name] = rng.randrange(control.positions)
+        line = plan.lines[control.name] = lines[callback]
+        plan.presses.extend([PlannedPress(control.name, callback, line.key, line.modifier)] * presses)
+    return plan
+
+COCKPIT_FLIGHTDATA_READER = Projection(FlightData, ["lightBits", "lightBits2", "lightBits3", "hsiBits"])
+COCKPIT_FLIGHTDATA2_READER = Projection(FlightData2, [
+    "altBits", "powerBits", "blinkBits", "miscBits", "ecmBits", "cmdsMode", "instrLight"])
+
+# bits of the shared memory bitfields (see FlightData.h of Falcon BMS) as
+# (word, mask); a mask of several bits is decoded as a number
+COCKPIT_BITS = {
+    "MasterCaution": ("lightBits", 0x1),
+    "EquipHot": ("lightBits", 0x8),
+    "OnGround": ("lightBits", 0x10),
+    "Avionics": ("lightBits", 0x800000),
+    "RadarAlt": ("lightBits", 0x1000000),
+    "IFF": ("lightBits", 0x2000000),
+    "ECM": ("lightBits", 0x4000000),
+    "AutoPilotOn": ("lightBits", 0x40000000),
+    "AuxPwr": ("lightBits2", 0x8000),
+    "EcmPwr": ("lightBits2", 0x10000),
+    "EcmFail": ("lightBits2", 0x20000),
+    "EPUOn": ("lightBits2", 0x100000),
+    "JFSOn": ("lightBits2", 0x200000),
+    "ProbeHeat": ("lightBits2", 0x1000000),
+    "SeatArm": ("lightBits2", 0x2000000),
+    "AntiSkid": ("lightBits2", 0x10000000),
+    "MainGen": ("lightBits3", 0x2),
+    "StbyGen": ("lightBits3", 0x4),
+    "ParkBrakeOn": ("lightBits3", 0x100000),
+    "PowerOff": ("lightBits3", 0x200000),
+    "AVTR": ("hsiBits", 0x2000),
+    "BusPowerBattery": ("powerBits", 0x1),
+    "BusPowerEmergency": ("powerBits", 0x2),
+    "BusPowerEssential": ("powerBits", 0x4),
+    "BusPowerNonEssential": ("powerBits", 0x8),
+    "MainGenerator": ("powerBits", 0x10),
+    "StandbyGenerator": ("powerBits", 0x20),
+    "JetFuelStarter": ("powerBits", 0x40),
+    "RALTValid": ("miscBits", 0x1),
+    "CalType": ("altBits", 0x1),
+    "PneuFlag": ("altBits", 0x2),
+    "OuterMarker": ("blinkBits", 0x1),
+    "MiddleMarker": ("blinkBits", 0x2),
+    "ProbeHeatBlink": ("blinkBits", 0x4),
+    "AuxSrch": ("blinkBits", 0x8),
+    "Launch": ("blinkBits", 0x10),
+    "PriMode": ("blinkBits", 0x20),
+    "ElecFault": ("blinkBits", 0x80),
+    "OxyBrow": ("blinkBits", 0x100),
+    "EPUOnBlink": ("blinkBits", 0x200),
+    "JFSOnSlow": ("blinkBits", 0x400),
+    "JFSOnFast": ("blinkBits", 0x800),
+    # the state of the 5 ECM pods' buttons
+    **{"Ecm{}".format(index): ("ecmBits{}".format(index), 0xFFFFFFFF) for index in range(5)},
+}
 
-def randomize_cockpit(keyfile_content):
+# the raw words of a CockpitState
+COCKPIT_WORDS = ("lightBits", "lightBits2", "lightBits3", "hsiBits", "altBits", "powerBits", "blinkBits",
+    "miscBits", "ecmBits0", "ecmBits1", "ecmBits2", "ecmBits3", "ecmBits4")
+
+def lowest_bit(mask):
+    return (mask & -mask).bit_length() - 1
+
+# name -> (word index, mask, shift)
+COCKPIT_DECODER = {
+    name: (COCKPIT_WORDS.index(word), mask, lowest_bit(mask)) for name, (word, mask) in COCKPIT_BITS.items()}
+# word index -> [(name, mask, shift)] of the bits in it, for diffing
+COCKPIT_WORD_BITS = [
+    [(name, mask, shift) for name, (index, mask, shift) in COCKPIT_DECODER.items() if index == word]
+    for word in range(len(COCKPIT_WORDS))]
+
+class CockpitState(tuple):
+    """Immutable state of the cockpit bitfields
+
+    A tuple of the raw COCKPIT_WORDS; every entry of COCKPIT_BITS is decoded from
+    them on access as an attribute (state.EcmPwr) using a precomputed mask and
+    shift. diff() compares two states word by word."""
+    __slots__ = ()
+    words = operator.attrgetter(*COCKPIT_WORDS)
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        return tuple.__new__(cls, cls.words(snapshot))
+
+    def __getattr__(self, name):
+        try:
+            index, mask, shift = COCKPIT_DECODER[name]
+        except KeyError:
+            raise AttributeError(name)
+        return (self[index] & mask) >> shift
+
+    def diff(self, other):
+        """Return {name: (old, new)} of the entries which differ in another state
+
+        Only the bits of the words which differ (XOR) are decoded."""
+        changed = {}
+        for index, (old, new) in enumerate(zip(self, other)):
+            flipped = old ^ new
+            if not flipped:
+                continue
+            for name, mask, shift in COCKPIT_WORD_BITS[index]:
+                if flipped & mask:
+                    changed[name] = ((old & mask) >> shift, (new & mask) >> shift)
+        return changed
+
+CockpitSnapshot = collections.namedtuple("CockpitSnapshot",
+    COCKPIT_FLIGHTDATA_READER.fields._fields + COCKPIT_FLIGHTDATA2_READER.fields._fields)
+
+def read_cockpit_snapshot(shared_memory):
+    """Read the cockpit related fields from the shared memory
+
+    Returns a CockpitSnapshot or None if the shared memory isn't available."""
+    flightdata = shared_memory.read(COCKPIT_FLIGHTDATA_READER)
+    flightdata2 = shared_memory.read(COCKPIT_FLIGHTDATA2_READER)
+    if flightdata is None or flightdata2 is None:
+        return None
+    return CockpitSnapshot(*flightdata, *flightdata2)
+
+def lamp_position(name):
+    """Observe a two-position switch through its lamp, which is only lit with battery power."""
+    word, mask = COCKPIT_BITS[name]
+    battery = COCKPIT_BITS["BusPowerBattery"][1]
+    read = operator.attrgetter(word)
+    def observe(snapshot):
+        if not snapshot.powerBits & battery:
+            return None
+        return 1 if read(snapshot) & mask else 0
+    return observe
+
+# controls whose position can be read back from the shared memory; each observer
+# returns the position index of the control or None if it can't be told. The
+# lamps are only lit with battery power, which is off when a randomization is
+# triggered (main power OFF), so only the EWS mode and the instrument lights are
+# verified after a randomization; --calibrate uses all four.
+CONTROL_OBSERVERS = {
+    "EWS MODE": lambda snapshot: snapshot.cmdsMode if 0 <= snapshot.cmdsMode < 6 else None,
+    "SimInstrumentLight": lambda snapshot: ord(snapshot.instrLight) if ord(snapshot.instrLight) < 3 else None,
+    "SimEcmPower": lamp_position("EcmPwr"),
+    "SimSeatArm": lamp_position("SeatArm"),
+}
+
+def expected_positions(plan, before):
+    """Return the expected position of every observable control of a plan
+
+    Cycling controls can only be expected if their position was known before the
+    randomization."""
+    expected = {}
+    for name in plan.lines:
+        observe = CONTROL_OBSERVERS.get(name)
+        if observe is None:
+            continue
+        if name in plan.positions:
+            expected[name] = plan.positions[name]
+        elif name in plan.steps and before is not None:
+            position = observe(before)
+            if position is not None:
+                expected[name] = (position + plan.steps[name]) % CALLBACK_CONTROLS[plan.lines[name].callback].positions
+    return expected
+
+def correction_keys(plan, expected, snapshot):
+    """Compare the observed controls to their expected positions
+
+    Returns the names of the controls which differ and the PlannedPresses which
+    move them into their expected positions."""
+    wrong = []
+    keys = []
+    for name, position in expected.items():
+        observed = CONTROL_OBSERVERS[name](snapshot)
+        if observed is None or observed == position:
+            continue
+        wrong.append(name)
+        line = plan.lines[name]
+        control = CALLBACK_CONTROLS[line.callback]
+        presses = 1 if control.direct else (position - observed) % control.positions
+        keys.extend([PlannedPress(name, line.callback, line.key, line.modifier)] * presses)
+    return wrong, keys
+
+def verify_randomization(plan, before, rounds=2, settle=0.2, gate=None):
+    """Verify the randomized cockpit and re-send the keys of controls that didn't land
+
+    Reads the observable controls back from the shared memory (with the main
+    power off, only the EWS mode and the instrument lights; see
+    CONTROL_OBSERVERS) and compares them to the plan; `before` is the
+    CockpitSnapshot taken before sending the plan. Only the keys for controls
+    which aren't in their planned position are sent again, for at most `rounds`
+    rounds. Returns the names of the controls which still differ."""
+    expected = expected_positions(plan, before)
+    wrong = []
+    for round in range(rounds + 1):
+        time.sleep(settle)
+        snapshot = read_cockpit_snapshot(shared_memory)
+        if snapshot is None:
+            return sorted(expected)
+        wrong, keys = correction_keys(plan, expected, snapshot)
+        if not wrong or round == rounds:
+            break
+        notify("\tCorrecting {} control(s): {}".format(len(wrong), ", ".join(wrong)))
+        if not input_engine.play(input_engine.compile_schedule(schedule_presses(keys, input_engine.max_run)), gate):
+            break
+    return wrong
+
+# delays tried by the calibration, from the slowest to the fastest
+CALIBRATION_LADDER = [0.03, 0.02, 0.015, 0.01, 0.007, 0.005, 0.003, 0.002, 0.001]
+
+def calibration_presses(analysis):
+    """Return the observable callbacks of a keyfile, grouped by modifier class
+
+    Returns {class: [RequiredLine]} with the lines of callbacks whose control can
+    be read back from the shared memory; see CONTROL_OBSERVERS."""
+    classes = collections.defaultdict(list)
+    for line in analysis.required_lines:
+        control = CALLBACK_CONTROLS.get(line.callback)
+        if control is not None and control.name in CONTROL_OBSERVERS:
+            classes[modifier_class(line.modifier)].append(line)
+    return classes
+
+def acknowledged(name, position, timeout=0.5):
+    """Wait until a control is observed in a position; return False on timeout."""
+    deadline = time.perf_counter() + timeout
+    while True:
+        snapshot = read_cockpit_snapshot(shared_memory)
+        if snapshot is not None and CONTROL_OBSERVERS[name](snapshot) == position:
+            return True
+        if time.perf_counter() > deadline:
+            return False
+        time.sleep(0.01)
+
+def press_acknowledged(engine, line):
+    """Press the key of a line once and check that its control moved
+
+    Returns None if the control can't be observed at the moment."""
+    control = CALLBACK_CONTROLS[line.callback]
+    snapshot = read_cockpit_snapshot(shared_memory)
+    observed = CONTROL_OBSERVERS[control.name](snapshot) if snapshot is not None else None
+    if observed is None:
+        return None
+    if control.direct:
+        position = control.callbacks.index(line.callback)
+        if position == observed:
+            # a direct set callback only shows up if it moves the control
+            return None
+    else:
+        position = (observed + 1) % control.positions
+    engine.play(engine.compile_key(line.key, line.modifier))
+    return acknowledged(control.name, position)
+
+def calibrate_pacing(analysis, backend, trials=5):
+    """Learn the shortest reliable delay for every modifier class
+
+    Each observable callback of a class is pressed `trials` times for every delay
+    of CALIBRATION_LADDER, going down until a press isn't acknowledged by the sim.
+    The delay kept is the shortest one which always worked, with a 50% margin.
+    Returns a KeyPacing with the classes which could be calibrated."""
+    labels = {"none": "without modifiers", "single": "with one modifier", "combo": "with modifier combos"}
+    delays = {}
+    for name, lines in sorted(calibration_presses(analysis).items()):
+        reliable = None
+        for delay in CALIBRATION_LADDER:
+            engine = InputEngine(backend, delay)
+            results = [press_acknowledged(engine, line) for line in lines for trial in range(trials)]
+            results = [result for result in results if result is not None]
+            if not results or not all(results):
+                break
+            reliable = delay
+        if reliable is None:
+            notify("\tCouldn't calibrate keys {}".format(labels[name]))
+            continue
+        delays[name] = round(reliable * 1.5, 4)
+        notify("\tKeys {}: {:.1f} ms".format(labels[name], delays[name] * 1000))
+    return KeyPacing(delays)
+
+def measure_throughput(analysis, pacing, delay=0.01, seed=0):
+    """Return the keys per second of a randomization with the given pacing
+
+    Plays the plan into a null backend, so only the delays are measured."""
+    engine = InputEngine(RecordingBackend(keep=False), delay, pacing)
+    plan = plan_randomization(analysis, random.Random(seed))
+    steps = engine.compile_schedule(schedule_presses(plan.presses))
+    start = time.perf_counter()
+    engine.play(steps)
+    elapsed = time.perf_counter() - start
+    return len(plan.presses) / elapsed if elapsed else 0
+
+PreparedRandomization = collections.namedtuple("PreparedRandomization", ["analysis", "profile", "plan", "panels"])
+
+def panel_presses(presses):
+    """Group presses by their panel
+
+    Yields (panel, presses) in the order of PANELS, followed by the presses of
+    controls which aren't on a panel."""
+    panels = collections.defaultdict(list)
+    for press in presses:
+        panels[CONTROL_PANELS.get(press.control, OTHER_PANEL)].append(press)
+    for panel in [panel for panel, controls in PANELS] + [OTHER_PANEL]:
+        if panels[panel]:
+            yield panel, panels[panel]
+
+def compile_panels(engine, panels):
+    """Schedule and compile the presses of every panel; yields (panel, steps)."""
+    for panel, presses in panels:
+        yield panel, engine.compile_schedule(schedule_presses(presses, engine.max_run))
+
+def prepare_randomization(analysis, rng=random, profile=None):
+    """Plan a randomization for an airframe and compile its key presses
+
+    The presses are split by panel (see panel_presses()), grouped into runs
+    sharing a modifier (see schedule_presses()) and compiled into the input steps
+    of the current input engine. Returns a PreparedRandomization, which
+    randomize_cockpit() only has to play."""
+    with instrumentation.timer("plan"):
+        plan = plan_randomization(analysis, rng, profile)
+        panels = list(compile_panels(input_engine, panel_presses(plan.presses)))
+    return PreparedRandomization(analysis, profile, plan, panels)
+
+def play_panels(panels, gate=None, on_panel=None):
+    """Play the steps of the panels one after the other
+
+    After each panel, on_panel(panel, seconds since the start) is called. The
+    time until the first panel is done is recorded as "first_panel". Returns
+    False if the sending was aborted."""
+    started = time.perf_counter()
+    for number, (panel, steps) in enumerate(panels):
+        if not input_engine.play(steps, gate):
+            return False
+        elapsed = time.perf_counter() - started
+        if number == 0:
+            instrumentation.record("first_panel", elapsed)
+        if on_panel is not None:
+            on_panel(panel, elapsed)
+    return True
+
+def notify_panel(panel, elapsed):
+    notify("\t{} ready ({:.2f}s)".format(panel, elapsed))
+
+def randomize_cockpit(analysis, verify=True, gate=None, prepared=None, on_panel=notify_panel, profile=None,
+        rng=random):
     """Randomize the cockpit
 
-    Randomizes the cockpit by simply triggering each callback a random number of times.
-    Switches and dials that can't be cycled (for example the air source) would always
-    get set to the state that's placed last in the keyfile. That's why the shuffle is
-    needed to make them random as well.
+    Randomizes the cockpit by sending the key presses of a randomization plan,
+    which puts every control into a random position; see plan_randomization().
+    Only the callbacks of the AirframeProfile are used, if one is passed. A
+    PreparedRandomization of the same analysis and profile can be passed,
+    otherwise one is prepared first with rng; see prepare_randomization(). The
+    panels are sent in cold start order and on_panel is called once each of them
+    is done; see play_panels().
+    If verify is set, the controls which can be read back are checked and
+    corrected afterwards; see verify_randomization(). A SendGate can be passed to
+    pause or abort the sending.
+    Returns the RandomizationPlan.
     """
-    winsound.PlaySound("Notification.Proximity", winsound.SND_ALIAS | winsound.SND_LOOP | winsound.SND_ASYNC)
-    random.shuffle(keyfile_content)
-    # TODO: use cached callbacks from somewhere else, don't go through whole keyfile again
-    for line in keyfile_content:
-        if line[0] in REQUIRED_CALLBACKS:
-            for rep in range(0, random.randint(1,6)):
-                send_key(line[3], line[4])
-    winsound.PlaySound(None, winsound.SND_FILENAME)
-    notify("Cockpit randomized!")
-
-def main():
-    """Runs Falcon-BCC
+    play_sound(True)
+    try:
+        if prepared is None or prepared.analysis is not analysis or prepared.profile is not profile:
+            prepared = prepare_randomization(analysis, rng, profile)
+        plan = prepared.plan
+        before = read_cockpit_snapshot(shared_memory) if verify else None
+        completed = play_panels(prepared.panels, gate, on_panel)
+        if completed and verify:
+            wrong = verify_randomization(plan, before, gate=gate)
+            if wrong:
+                notify("Warning: controls not in their planned position: {}".format(", ".join(wrong)))
+            after = read_cockpit_snapshot(shared_memory)
+            if before is not None and after is not None:
+                changed = CockpitState.from_snapshot(before).diff(CockpitState.from_snapshot(after))
+                if changed:
+                    notify("\tIndications changed: {}".format(", ".join(sorted(changed))))
+    finally:
+        play_sound(False)
+    if gate is not None and gate.aborted:
+        notify("Cockpit randomization aborted")
+    else:
+        notify("Cockpit randomized!")
+    return plan
+
+PolledState = collections.namedtuple("PolledState", ["in_3d", "on_ground", "end_flight", "main_power", "cmds_mode", "paused"])
+
+class StateWatcher():
+    """Watches the shared memory and emits transition events
+
+    Each poll reads the few fields needed through projections and compares them
+    to the previous poll. Subscribers of an event are called with the previous
+    and the current state (the previous one is None on the first poll). Events:
+    "entered_3d", "left_3d", "end_flight", "cmds_changed", "power_changed",
+    "ground_changed", "paused_changed".
+
+    The polling is fast only while the state is "hot" (by default in 3D, on the
+    ground and with the main power off), otherwise it backs off to the regular
+    refresh frequency, e.g. in the UI or in flight.
+    """
+
+    def __init__(self, shared_memory):
+        self.shared_memory = shared_memory
+        self.state = None
+        self.polled_at = None
+        self.subscribers = collections.defaultdict(list)
+        self.hot = lambda state: state.in_3d and state.on_ground and not state.main_power
+
+    def subscribe(self, event, callback):
+        self.subscribers[event].append(callback)
+
+    def emit(self, event, previous, state):
+        for callback in self.subscribers[event]:
+            callback(previous, state)
+
+    def read(self):
+        """Return the current PolledState or None if the shared memory isn't available."""
+        flightdata = self.shared_memory.read(FLIGHTDATA_READER)
+        flightdata2 = self.shared_memory.read(FLIGHTDATA2_READER)
+        intellivibedata = self.shared_memory.read(INTELLIVIBE_READER)
+        if flightdata is None or flightdata2 is None or intellivibedata is None:
+            return None
+        return PolledState(
+            intellivibedata.In3D,
+            intellivibedata.IsOnGround,
+            intellivibedata.IsEndFlight,
+            flightdata.MainPower,
+            flightdata2.cmdsMode,
+            intellivibedata.IsPaused)
+
+    def poll(self):
+        """Poll the shared memory once and emit the events for any transitions
+
+        Returns the number of seconds to wait before the next poll."""
+        self.polled_at = time.perf_counter()
+        with instrumentation.timer("poll"):
+            return self.poll_state()
+
+    def poll_state(self):
+        state = self.read()
+        if state is None:
+            return REFRESH_FREQUENCY
+        previous = self.state
+        self.state = state
+        if previous is None or state != previous:
+            if state.in_3d and (previous is None or not previous.in_3d):
+                self.emit("entered_3d", previous, state)
+            elif previous is not None and previous.in_3d and not state.in_3d:
+                self.emit("left_3d", previous, state)
+            if state.end_flight and (previous is None or not previous.end_flight):
+                self.emit("end_flight", previous, state)
+            if previous is None or state.cmds_mode != previous.cmds_mode:
+                self.emit("cmds_changed", previous, state)
+            if previous is None or state.main_power != previous.main_power:
+                self.emit("power_changed", previous, state)
+            if previous is None or state.on_ground != previous.on_ground:
+                self.emit("ground_changed", previous, state)
+            if previous is None or state.paused != previous.paused:
+                self.emit("paused_changed", previous, state)
+        if self.hot(state):
+            return FAST_REFRESH_FREQUENCY
+        return REFRESH_FREQUENCY
+
+class CockpitRandomizer():
+    """Randomizes the cockpit once per flight
+
+    Subscribes to a StateWatcher. The criteria for an eligible randomization are
+    that we're in 3D, the plane is on the ground, main power is not on, the cockpit
+    isn't already randomized and the CMDS mode is in STDBY (1). Leaving 3D after
+    the end of the flight rearms it.
+
+    The next randomization is prepared ahead of time, whenever the keyfile
+    analysis or the airframe changes and after every randomization, using rng
+    for its random choices. The preparations run one at a time in a single
+    planner thread, in the order they were requested, so that a seeded rng gives
+    the same plans on every run. Only the callbacks of the current
+    AirframeProfile are pressed; it's selected again when a randomization is
+    triggered, in case the jet changed since.
+
+    A triggered randomization is queued for sender(), which plays the prepared
+    one in a worker thread so the watcher keeps polling meanwhile. While it's
+    being sent, pausing the sim pauses the sending, and leaving 3D, taking off or
+    turning the main power on aborts it."""
+
+    def __init__(self, watcher, analysis, verify=True, rng=random, profile=None):
+        self.watcher = watcher
+        self.analysis = analysis
+        self.profile = profile
+        self.verify = verify
+        self.rng = rng
+        # future of the next PreparedRandomization
+        self.prepared = None
+        self.randomized = False
+        self.gate = None
+        self.queue = asyncio.Queue()
+        self.planner = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="falcon-bcc-planner")
+        for event in ("entered_3d", "cmds_changed", "power_changed", "ground_changed"):
+            watcher.subscribe(event, self.check_trigger)
+        for event in ("left_3d", "power_changed", "ground_changed", "paused_changed"):
+            watcher.subscribe(event, self.check_sending)
+        for event in ("end_flight", "left_3d"):
+            watcher.subscribe(event, self.check_rearm)
+        # only poll fast while a randomization could actually be triggered or is sent
+        watcher.hot = lambda state: self.armed(state) or self.gate is not None
+
+    def update(self, analysis):
+        """Use a new keyfile analysis and prepare the next randomization for it."""
+        self.analysis = analysis
+        self.prepare()
+
+    def select(self, profile):
+        """Use the AirframeProfile of a new jet and prepare the next randomization for it."""
+        if profile is self.profile:
+            return
+        notify("Airframe: {}".format(profile.name))
+        self.profile = profile
+        self.prepare()
+
+    def prepare(self):
+        loop = asyncio.get_running_loop()
+        self.prepared = loop.run_in_executor(self.planner, prepare_randomization, self.analysis, self.rng,
+            self.profile)
+
+    def close(self):
+        self.planner.shutdown(wait=False)
+
+    def armed(self, state):
+        return state.in_3d and state.on_ground and not state.main_power and not self.randomized
+
+    def check_trigger(self, previous, state):
+        if self.armed(state) and state.cmds_mode == 1:
+            self.select(current_airframe())
+            self.randomized = True
+            self.gate = SendGate()
+            if state.paused:
+                self.gate.pause()
+            self.queue.put_nowait((self.analysis, self.profile, self.gate, self.watcher.polled_at))
 
-    It waits for Falcon BMS to start, processes the keyfile, and then enters the main
-    loop where it randomizes the cockpit and listens for the end of the flight.
-    The criteria for an eligible randomization are that we're in 3D, the plane is on
-    the ground, main power is not on, the cockpit isn't already randomized and the CMDS
-    mode is in STDBY (1)."""
+    def check_sending(self, previous, state):
+        gate = self.gate
+        if gate is None:
+            return
+        if not state.in_3d or not state.on_ground or state.main_power:
+            gate.abort()
+        elif state.paused:
+            gate.pause()
+        else:
+            gate.resume()
+
+    def check_rearm(self, previous, state):
+        if self.randomized and state.end_flight and not state.in_3d:
+            notify("Left 3D, cockpit randomization rearmed")
+            self.randomized = False
+
+    async def sender(self):
+        """Run the queued randomizations, one at a time
+
+        A randomization which fails is reported and the next one is waited for."""
+        loop = asyncio.get_running_loop()
+        if self.prepared is None:
+            self.prepare()
+        while True:
+            analysis, profile, gate, triggered_at = await self.queue.get()
+            try:
+                try:
+                    prepared = await self.prepared
+                except Exception as e:
+                    notify("Warning: couldn't prepare the randomization: {}".format(e))
+                    prepared = None
+                if prepared is None or prepared.analysis is not analysis or prepared.profile is not profile:
+                    # prepared again in the planner thread, so a seeded rng stays in order
+                    prepared = await loop.run_in_executor(self.planner, prepare_randomization, analysis, self.rng,
+                        profile)
+                await loop.run_in_executor(None, randomize_cockpit, analysis, self.verify, gate, prepared,
+                    notify_panel, profile, self.rng)
+                instrumentation.record("trigger_to_done", time.perf_counter() - triggered_at)
+            except Exception as e:
+                # a failed randomization mustn't stop the ones triggered later
+                notify("Error: cockpit randomization failed: {!r}".format(e))
+            finally:
+                if self.gate is gate:
+                    self.gate = None
+                self.prepare()
+
+async def monitor(watcher, randomizer, keyfile_path):
+    """Poll the shared memory until Falcon BMS stops running
+
+    Whether the sim is still running, whether the keyfile changed and which
+    airframe is flown is only checked at the regular refresh frequency."""
+    next_check = time.monotonic() + REFRESH_FREQUENCY
+    while True:
+        if time.monotonic() >= next_check:
+            # remap the areas first, so a sim which is gone isn't read from stale
+            # mappings; not while keys are sent, the verification reads the areas
+            if randomizer.gate is None:
+                shared_memory.refresh()
+            if not falcon_running():
+                return
+            strings = read_shared_memory_strings()
+            if not keyfile_override and strings.KeyFile != keyfile_path:
+                notify("\tKeyfile changed, reprocessing...")
+                keyfile_path, analysis = process_keyfile()
+                randomizer.update(analysis)
+                notify("Ready: Move the CMDS knob to STBY to start randomizing")
+            randomizer.select(current_airframe())
+            instrumentation.flush()
+            next_check = time.monotonic() + REFRESH_FREQUENCY
+        await asyncio.sleep(watcher.poll())
+
+async def wait_for_sim(detector=None):
     notify("Waiting for Falcon BMS to start")
+    if detector is not None:
+        await detector.wait()
     while not falcon_running():
-        time.sleep(REFRESH_FREQUENCY)
+        await asyncio.sleep(REFRESH_FREQUENCY)
+
+async def calibrate(backend=None, detector=None):
+    """Calibrates the key pacing
+
+    Waits for the sim and the cockpit (in 3D with battery power), learns the
+    delays with calibrate_pacing() and saves them for this machine. The keys per
+    second of a randomization are reported with the previous and the new pacing.
+    The calibration moves the observable controls, so the cockpit isn't left as
+    it was."""
+    global input_engine
+    check_projections(FlightData, FlightData2, IntellivibeData)
+    backend = backend or SendInputBackend()
+    input_engine = InputEngine(backend)
+    await wait_for_sim(detector)
+    keyfile_path, analysis = process_keyfile()
+    if not calibration_presses(analysis):
+        notify("No callbacks which can be observed in the shared memory. Exiting")
+        return
+    notify("Calibrating: enter 3D with the battery on and keep the sim focused")
+    while True:
+        intellivibedata = shared_memory.read(INTELLIVIBE_READER)
+        if intellivibedata is not None and intellivibedata.In3D:
+            break
+        await asyncio.sleep(REFRESH_FREQUENCY)
+    previous = KeyPacing.load(PACING_PATH)
+    before = measure_throughput(analysis, previous)
+    loop = asyncio.get_running_loop()
+    pacing = await loop.run_in_executor(None, calibrate_pacing, analysis, backend)
+    if not pacing.delays:
+        notify("Calibration failed, keeping the previous key pacing")
+        return
+    pacing.save(PACING_PATH)
+    after = measure_throughput(analysis, pacing)
+    notify("Key pacing saved: {:.0f} keys/s before, {:.0f} keys/s after".format(before, after))
+
+async def run(backend=None, recorder=None, rng=random, detector=None, publisher=None, budget=None):
+    """Runs Falcon-BCC
 
-    keyfile_path, keyfile_content = process_keyfile()
-    cockpit_randomized = 0
+    It waits for Falcon BMS to start, processes the keyfile, and then runs two tasks:
+    the monitor, where a StateWatcher polls the shared memory and the
+    CockpitRandomizer reacts to its events, and the randomizer's sender, which sends
+    the keys of triggered randomizations. The keys go to the SendInput backend
+    unless another one is passed; the random choices are made with rng. A
+    SimDetector can be passed to wait for the sim; by default it's only checked
+    through the shared memory. A TelemetryPublisher publishes the shared memory
+    while the sim is running. The keys are sent within the budget of the input
+    engine, if passed. If a SharedMemoryRecorder is passed, it records the shared
+    memory while the sim is running. The randomizations only press the callbacks
+    of the airframe profile of the current jet."""
+    global input_engine
+    check_projections(FlightData, FlightData2, IntellivibeData)
+    pacing = KeyPacing.load(PACING_PATH)
+    if pacing is not None:
+        notify("Using the calibrated key pacing")
+    input_engine = InputEngine(backend or SendInputBackend(), pacing=pacing, budget=budget)
+    await wait_for_sim(detector)
+
+    keyfile_path, analysis = process_keyfile()
+    watcher = StateWatcher(shared_memory)
+    # a replayed cockpit doesn't react to the keys, so there's nothing to verify
+    randomizer = CockpitRandomizer(watcher, analysis, not isinstance(shared_memory, ReplaySharedMemory), rng)
+    randomizer.select(current_airframe())
     notify("Ready: Move the CMDS knob to STBY to start randomizing")
 
-    while falcon_running():
-        flightdata = read_shared_memory(FlightData)
-        flightdata2 = read_shared_memory(FlightData2)
-        intellivibedata = read_shared_memory(IntellivibeData)
-        strings = read_shared_memory_strings()
-
-        if strings.KeyFile != keyfile_path:
-            notify("\tKeyfile changed, reprocessing...")
-            keyfile_path, keyfile_content = process_keyfile()
-            notify("Ready: Move the CMDS knob to STBY to start randomizing")
-
-        in_3d = intellivibedata.In3D
-        on_ground = intellivibedata.IsOnGround
-        end_flight = intellivibedata.IsEndFlight
-        main_power = flightdata.MainPower
-        cmds_mode = flightdata2.cmdsMode
-        if in_3d and on_ground and not main_power and not cockpit_randomized and cmds_mode == 1:
-            randomize_cockpit(keyfile_content)
-            cockpit_randomized = 1
-        elif cockpit_randomized and end_flight and not in_3d:
-            notify("Left 3D, cockpit randomization rearmed")
-            cockpit_randomized = 0
-        time.sleep(REFRESH_FREQUENCY)
+    tasks = [asyncio.create_task(randomizer.sender())]
+    if recorder is not None:
+        tasks.append(asyncio.create_task(recorder.run()))
+    if publisher is not None:
+        tasks.append(asyncio.create_task(publisher.run()))
+    try:
+        await monitor(watcher, randomizer, keyfile_path)
+    finally:
+        if randomizer.gate is not None:
+            randomizer.gate.abort()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        randomizer.close()
+    shared_memory.release()
     notify("Falcon BMS not running. Exiting")
 
-main()
+def positive_int(text):
+    """Parse a whole number of at least 1 (an argparse type)."""
+    try:
+        value = int(text)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise argparse.ArgumentTypeError("expected a whole number of at least 1, not {!r}".format(text))
+    return value
+
+def parse_arguments(arguments=None):
+    parser = argparse.ArgumentParser(description="Randomizes the switches in the Falcon BMS cockpit.")
+    parser.add_argument("--metrics", metavar="PATH",
+        help="collect latency histograms and write them to this file")
+    parser.add_argument("--metrics-format", choices=["json", "prometheus"], default="json",
+        help="format of the metrics file (default: json)")
+    parser.add_argument("--metrics-interval", type=float, default=60, metavar="SECONDS",
+        help="how often the metrics file is written (default: 60)")
+    parser.add_argument("--profile", nargs="?", const="falcon-bcc.profile.txt", metavar="PATH",
+        help="sample the running code and write the collapsed stacks to this file")
+    parser.add_argument("--record", metavar="PATH",
+        help="record the shared memory into this file")
+    parser.add_argument("--record-rate", type=float, default=10, metavar="HZ",
+        help="how many times per second the shared memory is recorded (default: 10)")
+    parser.add_argument("--replay", metavar="PATH",
+        help="replay a recording instead of reading the shared memory; no keys are sent")
+    parser.add_argument("--replay-speed", type=float, default=1, metavar="FACTOR",
+        help="speed of the replay relative to the recording (default: 1)")
+    parser.add_argument("--shm-dir", metavar="DIR",
+        help="read the shared memory areas from files in this directory (e.g. on Linux)")
+    parser.add_argument("--calibrate", action="store_true",
+        help="learn how fast keys can be sent to the sim on this machine and exit")
+    parser.add_argument("--batch", metavar="PATH",
+        help="audit and patch the keyfiles in a directory or matching a glob pattern, without the sim")
+    parser.add_argument("--output-dir", default="falcon-bcc-keyfiles", metavar="DIR",
+        help="where --batch writes the patched keyfiles (default: falcon-bcc-keyfiles)")
+    parser.add_argument("--report", metavar="PATH",
+        help="where --batch writes its JSON report (default: report.json in the output directory)")
+    parser.add_argument("--jobs", type=int, metavar="N",
+        help="number of processes used by --batch (default: number of CPUs)")
+    parser.add_argument("--input-socket", metavar="PATH",
+        help="send the keys to this Unix datagram socket instead of the sim (see simulator.py)")
+    parser.add_argument("--seed", type=int,
+        help="seed of the random choices, for reproducible randomizations")
+    parser.add_argument("--publish", type=telemetry_address, metavar="ADDRESS",
+        help="publish the shared memory to other programs at udp:HOST:PORT or unix:PATH")
+    parser.add_argument("--publish-rate", type=float, default=20, metavar="HZ",
+        help="how many times per second changes are published (default: 20)")
+    parser.add_argument("--keys-per-frame", type=positive_int, metavar="N",
+        help="send at most N keys per --frame-time while randomizing (default: no limit)")
+    parser.add_argument("--frame-time", type=float, default=0.05, metavar="SECONDS",
+        help="time slice of --keys-per-frame (default: 0.05)")
+    parser.add_argument("--keyfile", metavar="PATH",
+        help="use this keyfile instead of the one in the shared memory")
+    parser.add_argument("--airframes", default=AIRFRAMES_DIRECTORY, metavar="DIR",
+        help="directory of the airframe profiles (default: airframes next to falcon-bcc.py)")
+    return parser.parse_args(arguments)
+
+def main(arguments=None):
+    global instrumentation, shared_memory, keyfile_override
+    arguments = parse_arguments(arguments)
+    use_airframes(AirframeProfiles.load(arguments.airframes))
+    if arguments.batch:
+        sys.exit(1 if batch(arguments.batch, arguments.output_dir, arguments.report, arguments.jobs) else 0)
+    if arguments.metrics:
+        instrumentation = Instrumentation(arguments.metrics, arguments.metrics_format, arguments.metrics_interval)
+    keyfile_override = arguments.keyfile
+    backend = recorder = detector = None
+    rng = random.Random(arguments.seed) if arguments.seed is not None else random
+    if arguments.replay:
+        shared_memory = ReplaySharedMemory(arguments.replay, arguments.replay_speed)
+        backend = RecordingBackend(keep=False)
+        notify("Replaying {} frame(s) of {}".format(len(shared_memory.index), arguments.replay))
+    else:
+        if arguments.shm_dir:
+            shared_memory = SharedMemory(arguments.shm_dir)
+        detector = SimDetector.create(arguments.shm_dir)
+        if arguments.input_socket:
+            backend = SocketBackend(arguments.input_socket)
+    if arguments.record:
+        recorder = SharedMemoryRecorder(arguments.record, shared_memory, arguments.record_rate)
+    publisher = None
+    if arguments.publish:
+        publisher = TelemetryPublisher(arguments.publish, shared_memory, arguments.publish_rate)
+    if arguments.calibrate:
+        main_task = calibrate(backend, detector)
+    else:
+        budget = (arguments.keys_per_frame, arguments.frame_time) if arguments.keys_per_frame else None
+        main_task = run(backend, recorder, rng, detector, publisher, budget)
+    try:
+        if arguments.profile:
+            with SamplingProfiler(arguments.profile):
+                asyncio.run(main_task)
+        else:
+            asyncio.run(main_task)
+    except KeyboardInterrupt:
+        notify("Interrupted. Exiting")
+    finally:
+        if recorder is not None:
+            recorder.close()
+        if publisher is not None:
+            publisher.close()
+        if arguments.replay:
+            notify("Replay ended, {} key event(s) would have been sent".format(backend.edges))
+        instrumentation.flush(force=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,370 @@
+#!/usr/bin/python
+
+# Falcon-BCC
+# Copyright 2021-2024 Dino Duratović
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# A stand-in for Falcon BMS, for end-to-end tests of Falcon-BCC on Linux.
+# Publishes the shared memory areas as files, runs Falcon-BCC against them and
+# applies the keys it sends to a simulated cockpit.
+
+import argparse
+import collections
+import ctypes
+import json
+import mmap
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmark import bcc, generate_keyfile, write_string_area
+
+class SimulatedCockpit():
+    """The switches of the cockpit, moved by the keys of a keyfile
+
+    Keeps the position of every control of the switch catalog and how often the
+    other callbacks were pressed. Keys are looked up in the keyfile, which is
+    reloaded whenever it changes (e.g. after Falcon-BCC patched it)."""
+
+    def __init__(self):
+        self.keyfile_path = None
+        self.keyfile_stamp = None
+        self.keys = {}
+        self.held = set()
+        self.positions = {control.name: 0 for control in bcc.SWITCH_CATALOG}
+        self.presses = collections.Counter()
+        self.unknown = 0
+
+    def load(self, keyfile_path):
+        stat = os.stat(keyfile_path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if keyfile_path == self.keyfile_path and stamp == self.keyfile_stamp:
+            return
+        self.keyfile_path = keyfile_path
+        self.keyfile_stamp = stamp
+        keyfile = bcc.get_keyfile_content(keyfile_path)
+        self.keys = {}
+        for binding in keyfile.bindings:
+            modifiers = bcc.MODIFIER_SCANCODES.get(binding.modifier)
+            if binding.key == bcc.UNASSIGNED_KEY or modifiers is None:
+                continue
+            self.keys.setdefault((int(binding.key, 16), frozenset(modifiers)), binding.callback)
+
+    def press(self, callback):
+        self.presses[callback] += 1
+        control = bcc.CALLBACK_CONTROLS.get(callback)
+        if control is None or control.positions is None:
+            return
+        if control.direct:
+            self.positions[control.name] = control.callbacks.index(callback)
+        else:
+            self.positions[control.name] = (self.positions[control.name] + 1) % control.positions
+
+    def apply(self, scancode, release):
+        """Apply a key edge; a callback is pressed when its key goes down."""
+        if scancode in MODIFIERS:
+            if release:
+                self.held.discard(scancode)
+            else:
+                self.held.add(scancode)
+            return
+        if release:
+            return
+        callback = self.keys.get((scancode, frozenset(self.held)))
+        if callback is None:
+            self.unknown += 1
+        else:
+            self.press(callback)
+
+MODIFIERS = {code for codes in bcc.MODIFIER_SCANCODES.values() for code in codes}
+
+# the flights alternate between these jets, the second matching airframes/f-16a-block-15.json
+JETS = ("F-16C-50", "F-16A-15 OCU")
+
+class KeyReceiver():
+    """Receives the packets of Falcon-BCC's SocketBackend in a thread
+
+    Every packet is timestamped when it's received and queued in packets."""
+
+    def __init__(self, path):
+        self.path = path
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(path)
+        self.packets = collections.deque()
+        self.thread = threading.Thread(target=self.receive, daemon=True)
+        self.thread.start()
+
+    def receive(self):
+        edge = bcc.SocketBackend.edge
+        while True:
+            try:
+                data = self.socket.recv(65536)
+            except OSError:
+                return
+            now = time.perf_counter()
+            self.packets.append((now, [edge.unpack_from(data, offset) for offset in range(0, len(data), edge.size)]))
+
+    def close(self):
+        self.socket.close()
+        os.unlink(self.path)
+
+class SimulatedSim():
+    """Publishes the shared memory areas of a simulated session
+
+    The areas are files in a directory, written through shared mappings, so
+    Falcon-BCC can read them with --shm-dir. The string area is replaced as a
+    whole when the keyfile changes, and FlightData2.StringAreaTime is bumped."""
+
+    def __init__(self, directory, keyfile_path):
+        self.directory = directory
+        self.staging = os.path.join(directory, "staging")
+        os.makedirs(self.staging, exist_ok=True)
+        self.mappings = []
+        self.flightdata = self.map(bcc.FlightData)
+        self.flightdata2 = self.map(bcc.FlightData2)
+        self.intellivibedata = self.map(bcc.IntellivibeData)
+        self.cockpit = SimulatedCockpit()
+        self.set_keyfile(keyfile_path)
+
+    def map(self, structure):
+        path = os.path.join(self.directory, structure.name)
+        with open(path, "wb") as area:
+            area.write(bytes(ctypes.sizeof(structure)))
+        with open(path, "r+b") as area:
+            mapping = mmap.mmap(area.fileno(), ctypes.sizeof(structure))
+        self.mappings.append(mapping)
+        return structure.from_buffer(mapping)
+
+    def set_keyfile(self, keyfile_path, ac_name=JETS[0]):
+        write_string_area(self.staging, {"KeyFile": keyfile_path, "AcName": ac_name})
+        os.replace(os.path.join(self.staging, bcc.Strings.name), os.path.join(self.directory, bcc.Strings.name))
+        self.flightdata2.StringAreaTime += 1
+        self.keyfile_path = keyfile_path
+
+    def set_state(self, in_3d, on_ground=True, end_flight=False):
+        self.intellivibedata.In3D = in_3d
+        self.intellivibedata.IsOnGround = on_ground
+        self.intellivibedata.IsEndFlight = end_flight
+
+    def publish(self):
+        """Write the simulated cockpit into the areas."""
+        positions = self.cockpit.positions
+        self.flightdata2.cmdsMode = positions["EWS MODE"]
+        self.flightdata2.instrLight = bytes([positions["SimInstrumentLight"]])
+        # the battery bus is powered with the main power switch in BATT or MAIN PWR
+        battery = self.intellivibedata.In3D and self.flightdata.MainPower > 0
+        self.flightdata2.powerBits = bcc.COCKPIT_BITS["BusPowerBattery"][1] if battery else 0
+        lightbits2 = 0
+        if battery and positions["SimEcmPower"]:
+            lightbits2 |= bcc.COCKPIT_BITS["EcmPwr"][1]
+        if battery and positions["SimSeatArm"]:
+            lightbits2 |= bcc.COCKPIT_BITS["SeatArm"][1]
+        self.flightdata.lightBits2 = lightbits2
+
+    def close(self):
+        self.flightdata = self.flightdata2 = self.intellivibedata = None
+        for mapping in self.mappings:
+            mapping.close()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.isfile(path):
+                os.unlink(path)
+
+class Session():
+    """Runs scripted flights against a Falcon-BCC process
+
+    Each flight goes through the UI, 3D on the ground, the CMDS knob to STBY (which
+    triggers the randomization), the end of the flight and a new keyfile for the
+    next one. The keys are applied to the simulated cockpit at the update rate."""
+
+    def __init__(self, sim, receiver, process, rate):
+        self.sim = sim
+        self.receiver = receiver
+        self.process = process
+        self.interval = 1 / rate
+        self.keys = []
+        self.frames = 0
+        self.frame_times = []
+
+    def step(self):
+        """Apply the received keys and publish one frame."""
+        start = time.perf_counter()
+        self.sim.cockpit.load(self.sim.keyfile_path)
+        while self.receiver.packets:
+            received, edges = self.receiver.packets.popleft()
+            for scancode, release in edges:
+                if scancode not in MODIFIERS and not release:
+                    self.keys.append(received)
+                self.sim.cockpit.apply(scancode, release)
+        self.sim.publish()
+        self.frames += 1
+        self.frame_times.append(time.perf_counter() - start)
+
+    def hold(self, seconds, until=None):
+        """Keep publishing for some seconds or until a condition is met."""
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("Falcon-BCC exited with {}".format(self.process.returncode))
+            self.step()
+            if until is not None and until():
+                return True
+            time.sleep(self.interval)
+        return False
+
+    def flight(self, keyfile_path, ac_name=JETS[0], quiet=1.5, timeout=60):
+        """Fly one scripted flight and return its measurements."""
+        self.sim.set_state(False)
+        self.hold(1)
+        self.sim.set_state(True)
+        self.sim.cockpit.positions["EWS MODE"] = 0
+        # the randomizer only polls fast once the cockpit is armed
+        self.hold(2.5)
+        start = len(self.keys)
+        self.sim.cockpit.positions["EWS MODE"] = 1
+        triggered = time.perf_counter()
+        if not self.hold(timeout, lambda: len(self.keys) > start):
+            raise RuntimeError("no keys received within {}s of the trigger".format(timeout))
+        # the randomization (including its corrections) is done once the keys stop
+        self.hold(timeout, lambda: time.perf_counter() - self.keys[-1] > quiet)
+        keys = self.keys[start:]
+        result = {
+            "trigger_to_first_key": keys[0] - triggered,
+            "send_duration": keys[-1] - keys[0],
+            "keys": len(keys),
+            "keys_per_second": (len(keys) - 1) / (keys[-1] - keys[0]) if len(keys) > 1 else None,
+            "rss": rss(self.process.pid),
+        }
+        self.sim.set_state(True, end_flight=True)
+        self.hold(1)
+        self.sim.set_state(False, end_flight=True)
+        self.hold(2.5)
+        # the next flight uses a different keyfile (and jet), which Falcon-BCC has to process
+        self.sim.set_keyfile(keyfile_path, ac_name)
+        self.hold(2.5)
+        return result
+
+def rss(pid):
+    """Return the resident memory of a process in KiB (Linux only) or None."""
+    try:
+        with open("/proc/{}/status".format(pid), "r") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def summarize(flights, session):
+    """Return the report of a session."""
+    def stats(name):
+        values = [flight[name] for flight in flights if flight[name] is not None]
+        if not values:
+            return None
+        return {"median": statistics.median(values), "min": min(values), "max": max(values)}
+    report = {name: stats(name) for name in ("trigger_to_first_key", "send_duration", "keys", "keys_per_second")}
+    report["flights"] = len(flights)
+    report["frames"] = session.frames
+    report["frame_time_max"] = max(session.frame_times)
+    report["unknown_keys"] = session.sim.cockpit.unknown
+    memory = [flight["rss"] for flight in flights if flight["rss"] is not None]
+    if memory:
+        report["rss_first"] = memory[0]
+        report["rss_last"] = memory[-1]
+    if len(flights) >= 4:
+        # drift: the latency of the last quarter of the flights compared to the first
+        quarter = len(flights) // 4
+        first = statistics.median(flight["trigger_to_first_key"] for flight in flights[:quarter])
+        last = statistics.median(flight["trigger_to_first_key"] for flight in flights[-quarter:])
+        report["latency_drift"] = last - first
+    report["per_flight"] = flights
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Falcon BMS stand-in for testing Falcon-BCC")
+    parser.add_argument("--rate", type=float, default=50, help="shared memory updates per second (default: 50)")
+    parser.add_argument("--flights", type=int, default=3, help="number of scripted flights (default: 3)")
+    parser.add_argument("--duration", type=float, metavar="SECONDS",
+        help="keep flying until this many seconds have passed (a soak test), instead of --flights")
+    parser.add_argument("--lines", type=int, default=2000, help="lines of the generated keyfiles (default: 2000)")
+    parser.add_argument("-o", "--output", help="write the report to this JSON file")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show Falcon-BCC's output")
+    parser.add_argument("falcon_bcc_arguments", nargs="*",
+        help="extra arguments for Falcon-BCC (after --), e.g. --metrics")
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="falcon-bcc-sim-") as workdir:
+        directory = os.path.join(workdir, "shm")
+        os.mkdir(directory)
+        keyfiles = []
+        for number in range(2):
+            path = os.path.join(workdir, "flight-{}.key".format(number))
+            with open(path, "wb") as keyfile:
+                keyfile.write(generate_keyfile(arguments.lines, seed=number))
+            keyfiles.append(path)
+
+        sim = SimulatedSim(directory, keyfiles[0])
+        receiver = KeyReceiver(os.path.join(workdir, "input.sock"))
+        environment = dict(os.environ, XDG_CACHE_HOME=os.path.join(workdir, "cache"))
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "falcon-bcc.py")
+        process = subprocess.Popen(
+            [sys.executable, script, "--shm-dir", directory, "--input-socket", receiver.path]
+                + arguments.falcon_bcc_arguments,
+            env=environment,
+            stdout=None if arguments.verbose else subprocess.DEVNULL)
+        session = Session(sim, receiver, process, arguments.rate)
+        flights = []
+        started = time.perf_counter()
+        try:
+            # give Falcon-BCC the time to find the sim and process the keyfile
+            session.hold(3)
+            while True:
+                if arguments.duration is None and len(flights) == arguments.flights:
+                    break
+                if arguments.duration is not None and time.perf_counter() - started > arguments.duration:
+                    break
+                flights.append(session.flight(
+                    keyfiles[(len(flights) + 1) % len(keyfiles)], JETS[(len(flights) + 1) % len(JETS)]))
+                print("Flight {}: {} keys, {:.3f}s from the trigger to the first key, {:.0f} keys/s".format(
+                    len(flights), flights[-1]["keys"], flights[-1]["trigger_to_first_key"],
+                    flights[-1]["keys_per_second"] or 0))
+        finally:
+            # Falcon-BCC exits once the sim is gone
+            sim.close()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            receiver.close()
+
+    if not flights:
+        sys.exit(1)
+    report = summarize(flights, session)
+    for name in ("trigger_to_first_key", "send_duration", "keys_per_second"):
+        print("{:24} {}".format(name, report[name]))
+    for name in ("unknown_keys", "rss_first", "rss_last", "latency_drift"):
+        if name in report:
+            print("{:24} {}".format(name, report[name]))
+    if arguments.output:
+        with open(arguments.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+if __name__ == "__main__":
+    main()